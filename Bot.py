@@ -1,8 +1,15 @@
+import time
+
+# everything imported below counts as import time in the startup breakdown
+IMPORT_STARTED = time.perf_counter()
+
 import asyncio
 import json
 import os
 import platform
 import random
+import resource
+import signal
 import sys
 import traceback
 
@@ -14,24 +21,55 @@ from discord.ext.commands import AutoShardedBot
 from discord.ext.commands import Context
 
 from config import load_config
+from helpers.cluster import ClusterClient
+from helpers.gateway import bot_options
+from helpers.metrics import counter, gauge, registry
+from helpers.startup import load_synced_hash, save_synced_hash, startup, tree_hash
 
 SERVER_BOT = "DISCORD"
-intents = discord.Intents.default()
-intents.members = True
-intents.presences = True
-intents.messages = True
-intents.message_content = True
+
+# set when started by cluster.py, this process then runs only its shard range
+cluster = ClusterClient.from_env()
 
 bot = AutoShardedBot(
     command_prefix=commands.when_mentioned,
-    intents=intents,
     owner_ids=load_config()['discord']['owner_ids'],
     help_command=None,
     sync_commands=True,
-    activity=discord.Activity(type=discord.ActivityType.listening, name="/chat")
+    activity=discord.Activity(type=discord.ActivityType.listening, name="/chat"),
+    **bot_options(load_config()['discord']),
+    **(cluster.bot_options() if cluster is not None else {})
 )
 
 bot.config = load_config()
+bot.cluster = cluster
+bot.launched = time.time()
+startup.started = IMPORT_STARTED
+startup.record("import", time.perf_counter() - IMPORT_STARTED)
+
+COMMANDS = counter("chatbot_commands_total", "Prefix commands completed, by command")
+gauge(
+    "chatbot_gateway_latency_seconds", "Gateway heartbeat latency per shard",
+    lambda: [({"shard": str(shard_id)}, latency) for shard_id, latency in bot.latencies]
+)
+gauge(
+    "chatbot_startup_seconds", "Time spent in each startup stage",
+    lambda: [({"stage": name}, seconds) for name, seconds in startup.stages.items()]
+)
+
+
+@bot.event
+async def setup_hook() -> None:
+    """
+    Runs once after login and before connecting to the gateway, on the bot's own loop
+    """
+    startup.end("login")
+    with startup.stage("cog_load"):
+        await load_cogs()
+    with startup.stage("tree_sync"):
+        await sync_tree()
+    startup.begin("gateway_ready")
+
 
 @bot.event
 async def on_ready() -> None:
@@ -45,7 +83,11 @@ async def on_ready() -> None:
     print(f"Owner ID: {bot.owner_ids}")
     print(f"Admin: {bot.config['discord']['admin']}")
     print("-------------------")
-    await bot.tree.sync()
+    # on_ready fires again after every reconnect, the breakdown is only for the first one
+    if not startup.reported:
+        startup.end("gateway_ready")
+        startup.reported = True
+        print(startup.summary())
 
 
 @bot.event
@@ -69,6 +111,7 @@ async def on_command_completion(context: Context) -> None:
     full_command_name = context.command.qualified_name
     split = full_command_name.split(" ")
     executed_command = str(split[0])
+    COMMANDS.inc(command=executed_command)
     if context.guild is not None:
         print(
             f"Executed {executed_command} command in {context.guild.name} (ID: {context.guild.id}) "
@@ -78,6 +121,30 @@ async def on_command_completion(context: Context) -> None:
         print(f"Executed {executed_command} command by {context.author} (ID: {context.author.id}) in DMs")
 
 
+@bot.command(name="cluster", usage="cluster <status/restart>")
+@commands.is_owner()
+async def cluster_command(ctx, action: str = "status"):
+    """Show cluster health or start a rolling restart"""
+    try:
+        if bot.cluster is None:
+            await ctx.send(f'{ctx.author.mention}, not running in cluster mode.')
+            return
+        if action.lower() == "restart":
+            started = await bot.cluster.call("restart")
+            await ctx.send(f'{ctx.author.mention}, rolling restart {"started" if started else "already running"}.')
+            return
+        status = await bot.cluster.call("status")
+        lines = []
+        for cluster_id, report in status.items():
+            lines.append("cluster {}: {} shards {} guilds {} latency {}ms, {}".format(
+                cluster_id, "ready" if report['ready'] else "starting", report['shard_ids'], report['guilds'],
+                int(report['latency'] * 1000), "connected" if report['connected'] else "disconnected"
+            ))
+        await ctx.send("```\n{}\n```".format("\n".join(lines)))
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+
+
 @bot.command(usage="reconfig")
 @commands.is_owner()
 async def reconfig(ctx):
@@ -178,15 +245,83 @@ async def load_cogs() -> None:
                 exception = f"{type(e).__name__}: {e}"
                 print(f"Failed to load extension {extension}\n{exception}")
 
+async def sync_tree() -> None:
+    """
+    Sync the global application commands only when they changed since the last sync,
+    the hash of the synced tree is kept per application in [discord] tree_hash_file.
+    In cluster mode only cluster 0 syncs, the tree is the same everywhere.
+    """
+    try:
+        if bot.cluster is not None and bot.cluster.cluster_id != 0:
+            return
+        path = bot.config['discord'].get('tree_hash_file', "tree_sync.json")
+        digest = tree_hash(bot.tree)
+        if load_synced_hash(path, bot.application_id) == digest:
+            print("Application commands unchanged, not syncing")
+            return
+        synced = await bot.tree.sync()
+        save_synced_hash(path, bot.application_id, digest)
+        print(f"Synced {len(synced)} application commands")
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+
+
 def reload_config():
     bot.config = load_config()
 
 
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server():
+    """
+    Serve /metrics for Prometheus scraping when [metrics] enable = 1,
+    cluster workers listen on port + cluster id
+    """
+    config = bot.config.get('metrics', {})
+    if config.get('enable', 0) != 1:
+        return None
+    host = config.get('host', "127.0.0.1")
+    port = config.get('port', 9100) + (bot.cluster.cluster_id if bot.cluster is not None else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"Metrics listening on {host}:{port}/metrics")
+    return runner
+
+
+def collect_health() -> dict:
+    return {
+        "pid": os.getpid(),
+        "shard_ids": bot.cluster.shard_ids,
+        "ready": bot.is_ready(),
+        "guilds": len(bot.guilds),
+        "latency": bot.latency if bot.latency == bot.latency else 0.0,
+        "uptime": int(time.time() - bot.launched),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
 async def main():
+    metrics_runner = await start_metrics_server()
+    if bot.cluster is not None:
+        # cluster.py stops workers with SIGTERM: close cleanly so cogs flush their buffers
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        bot.cluster.start_reporting(collect_health)
     async with bot:
-        await bot.start(bot.config['discord']['token'])
+        try:
+            startup.begin("login")
+            await bot.start(bot.config['discord']['token'])
+        finally:
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            if bot.cluster is not None:
+                await bot.cluster.close()
 
 
-asyncio.run(load_cogs())
 asyncio.run(main())
 
@@ -0,0 +1,171 @@
+"""
+Response splitting on large answers: the previous fence-splitting loop of send_message
+against helpers.chunker.split_message.
+
+    python -m benchmarks.bench_chunker --size 60000 --limit 1900
+    python -m benchmarks.bench_chunker --check 2000     # randomized property check, exit 1 on failure
+
+The check splits seeded random markdown (prose, code blocks with and without a language,
+empty blocks, blank lines, lines longer than the limit) at random limits and asserts that
+every chunk is non-empty and within the limit, has balanced code fences, and that the chunks
+joined with "\n" hold the input's text: the same characters in the same order once fence
+lines and whitespace are set aside, since cuts add line breaks and fences are closed and reopened.
+"""
+import argparse
+import random
+import re
+import sys
+import time
+
+from helpers.chunker import split_message
+
+
+def legacy_split(response: str, char_limit: int) -> list:
+    """
+    Messages the previous send_message code would send
+    """
+    messages = []
+    if len(response) <= char_limit:
+        return [response]
+    if "```" in response:
+        parts = response.split("```")
+        for i in range(len(parts)):
+            if i % 2 == 0:
+                messages.append(parts[i])
+            else:
+                code_block = parts[i].split("\n")
+                formatted_code_block = ""
+                for line in code_block:
+                    while len(line) > char_limit:
+                        formatted_code_block += line[:char_limit] + "\n"
+                        line = line[char_limit:]
+                    formatted_code_block += line + "\n"
+                if len(formatted_code_block) > char_limit + 100:
+                    for j in range(0, len(formatted_code_block), char_limit):
+                        messages.append(f"```{formatted_code_block[j:j + char_limit]}```")
+                else:
+                    messages.append(f"```{formatted_code_block}```")
+    else:
+        messages = [response[i:i + char_limit] for i in range(0, len(response), char_limit)]
+    return messages
+
+
+def make_response(size: int, seed: int = 42) -> str:
+    """
+    Markdown answer of about `size` characters mixing prose and fenced code
+    """
+    rng = random.Random(seed)
+    words = ["the", "function", "returns", "a", "list", "of", "values", "when", "called", "with"]
+    blocks = []
+    total = 0
+    while total < size:
+        if rng.random() < 0.35:
+            lines = ["    result = compute({}, {})".format(rng.randint(0, 99), rng.randint(0, 99))
+                     for _ in range(rng.randint(3, 80))]
+            block = "```python\n" + "\n".join(lines) + "\n```"
+        else:
+            block = " ".join(rng.choice(words) for _ in range(rng.randint(20, 200)))
+        blocks.append(block)
+        total += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def make_markdown(rng: random.Random) -> str:
+    """
+    Small random answer exercising the chunker's edge cases
+    """
+    words = ["alpha", "beta", "gamma", "x", "def", "return", "é", "naïve", "{", "}", "#", "-", "1.", "`code`"]
+    blocks = []
+    for _ in range(rng.randint(1, 12)):
+        kind = rng.random()
+        if kind < 0.3:
+            language = rng.choice(["", "python", "js", "diff"])
+            lines = [
+                " " * rng.randint(0, 8) + " ".join(rng.choice(words) for _ in range(rng.randint(0, 15)))
+                for _ in range(rng.randint(0, 20))
+            ]
+            blocks.append("\n".join(["```" + language] + lines + ["```"]))
+        elif kind < 0.35:
+            # a code block on one line, opening and closed on the same line
+            code = " ".join(rng.choice(["pip", "install", "x", "=", "1"]) for _ in range(rng.randint(1, 4)))
+            blocks.append(rng.choice(["", "  "]) + "```" + code + "```")
+        elif kind < 0.4:
+            # one line longer than most limits, with or without spaces to cut at
+            sep = rng.choice([" ", ""])
+            blocks.append(sep.join(rng.choice(words) for _ in range(rng.randint(50, 400))))
+        else:
+            blocks.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 120))))
+    return rng.choice(["\n", "\n\n", "\n\n\n"]).join(blocks)
+
+
+def is_fence(line: str) -> bool:
+    return line.lstrip().startswith("```") and line.count("```") < 2
+
+
+def text_only(text: str) -> str:
+    return re.sub(r"\s+", "", "".join(line for line in text.splitlines() if not is_fence(line)))
+
+
+def check_split(text: str, limit: int) -> list:
+    """
+    Property violations of split_message(text, limit), empty when it holds
+    """
+    chunks = split_message(text, limit)
+    problems = []
+    for i, chunk in enumerate(chunks):
+        if len(chunk) > limit:
+            problems.append(f"chunk {i} has {len(chunk)} characters, limit {limit}")
+        if not chunk.strip():
+            problems.append(f"chunk {i} is empty")
+        if sum(1 for line in chunk.splitlines() if is_fence(line)) % 2:
+            problems.append(f"chunk {i} has an unclosed code block")
+    if text_only("\n".join(chunks)) != text_only(text):
+        problems.append("joined chunks do not hold the input text")
+    return problems
+
+
+def check(cases: int, seed: int) -> int:
+    rng = random.Random(seed)
+    failures = 0
+    for case in range(cases):
+        text = make_markdown(rng)
+        limit = rng.choice([rng.randint(30, 200), rng.randint(200, 2000)])
+        problems = check_split(text, limit)
+        if problems:
+            failures += 1
+            if failures <= 5:
+                print(f"case {case} (limit {limit}): " + "; ".join(problems))
+                print(repr(text[:300]))
+    print(f"{cases - failures}/{cases} cases hold (seed {seed})")
+    return 1 if failures else 0
+
+
+def measure(split, response: str, limit: int, rounds: int) -> tuple:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        messages = split(response, limit)
+    elapsed = (time.perf_counter() - started) / rounds
+    return elapsed, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=60000)
+    parser.add_argument("--limit", type=int, default=1900)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--check", type=int, metavar="CASES", help="run the randomized property check instead")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(check(args.check, args.seed))
+    response = make_response(args.size)
+    for name, split in (("legacy", legacy_split), ("chunker", split_message)):
+        elapsed, messages = measure(split, response, args.limit, args.rounds)
+        print("{:8} {:8.3f}ms  {:4d} messages, {} empty, {} over 2000 chars".format(
+            name, elapsed * 1000, len(messages),
+            sum(1 for m in messages if not m.strip()), sum(1 for m in messages if len(m) > 2000)
+        ))
+
+
+if __name__ == "__main__":
+    main()
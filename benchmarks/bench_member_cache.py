@@ -0,0 +1,118 @@
+"""
+Resident memory of the gateway cache for a simulated large guild set: the previous intents
+(default + members + presences, every member cached) against helpers.gateway's defaults.
+
+    python -m benchmarks.bench_member_cache --guilds 300 --members 2000
+
+Each policy runs in its own process. GUILD_CREATE payloads are built the way Discord sends them
+for the policy's intents (members only with the members intent, presences only with the
+presences intent) and fed to discord.py's connection state, no network involved.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import subprocess
+import sys
+
+import discord
+
+from helpers.gateway import bot_options
+
+BOT_ID = 10 ** 17
+
+
+def rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def legacy_options() -> dict:
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.presences = True
+    intents.messages = True
+    intents.message_content = True
+    return {"intents": intents, "member_cache_flags": discord.MemberCacheFlags.from_intents(intents)}
+
+
+def member(user_id: int) -> dict:
+    return {
+        "user": {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None},
+        "roles": [], "joined_at": "2023-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0,
+    }
+
+
+def guild_payload(guild_id: int, members: int, intents: discord.Intents) -> dict:
+    ids = [BOT_ID] + [BOT_ID + guild_id * members + i + 1 for i in range(members)]
+    channels = [
+        {"id": str(guild_id * 1000 + i), "type": 0, "name": f"channel-{i}", "position": i, "permission_overwrites": []}
+        for i in range(20)
+    ]
+    return {
+        "id": str(guild_id), "name": f"guild-{guild_id}", "icon": None, "owner_id": str(ids[-1]),
+        "roles": [{
+            "id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+            "hoist": False, "managed": False, "mentionable": False, "flags": 0,
+        }],
+        "emojis": [], "features": [], "member_count": members + 1, "large": members > 250,
+        # without the members intent Discord only sends the bot itself (and voice members)
+        "members": [member(i) for i in (ids if intents.members else ids[:1])],
+        "presences": [
+            {"user": {"id": str(i)}, "status": "online", "activities": [], "client_status": {"desktop": "online"}}
+            for i in ids[1:members // 4]
+        ] if intents.presences else [],
+        "channels": channels, "threads": [], "voice_states": [], "stage_instances": [],
+        "guild_scheduled_events": [], "stickers": [],
+    }
+
+
+async def measure(policy: str, guilds: int, members: int) -> dict:
+    options = legacy_options() if policy == "legacy" else bot_options({})
+    client = discord.AutoShardedClient(**options)
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data={
+        "id": str(BOT_ID), "username": "bot", "discriminator": "0", "avatar": None, "global_name": None
+    })
+    gc.collect()
+    before = rss_kb()
+    for guild_id in range(1, guilds + 1):
+        state._add_guild_from_data(guild_payload(guild_id, members, options["intents"]))
+    gc.collect()
+    return {
+        "policy": policy,
+        "rss_kb": rss_kb() - before,
+        "cached_members": sum(len(guild.members) for guild in client.guilds),
+        "intents": options["intents"].value,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=300)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--policy", choices=["legacy", "configured"], help="measure one policy in this process")
+    args = parser.parse_args()
+    if args.policy:
+        print(json.dumps(asyncio.run(measure(args.policy, args.guilds, args.members))))
+        return
+    results = []
+    for policy in ("legacy", "configured"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_member_cache", "--policy", policy,
+             "--guilds", str(args.guilds), "--members", str(args.members)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output))
+    for result in results:
+        print("{:10} {:8.1f} MB  {:8d} cached members".format(
+            result["policy"], result["rss_kb"] / 1024, result["cached_members"]
+        ))
+    print("{:.1f}x less memory".format(results[0]["rss_kb"] / max(1, results[1]["rss_kb"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Throughput of concurrent chat completion streams against the local mock server.
+
+    python -m benchmarks.bench_streams --streams 500 --chunks 50 --delay 0.02
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.mock_sse_server import start_server
+from helpers.openai_client import OpenAIClient
+
+
+async def run(streams: int, chunks: int, delay: float, connection_limit: int) -> dict:
+    runner, url = await start_server(chunks=chunks, delay=delay)
+    client = OpenAIClient("mock", url=url, connection_limit=connection_limit)
+    json_data = {"model": "mock", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+    async def one_stream() -> int:
+        received = 0
+        async for resp in client.stream_chat(json_data):
+            if resp["choices"][0]["delta"].get("content"):
+                received += 1
+        return received
+
+    try:
+        started = time.perf_counter()
+        received = await asyncio.gather(*[one_stream() for _ in range(streams)])
+        elapsed = time.perf_counter() - started
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return {
+        "streams": streams,
+        "chunks": sum(received),
+        "elapsed": elapsed,
+        "streams_per_s": streams / elapsed,
+        "chunks_per_s": sum(received) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", type=int, default=500)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--connection-limit", type=int, default=1000)
+    args = parser.parse_args()
+    result = asyncio.run(run(args.streams, args.chunks, args.delay, args.connection_limit))
+    print(
+        "{streams} streams, {chunks} chunks in {elapsed:.2f}s: "
+        "{streams_per_s:.1f} streams/s, {chunks_per_s:.0f} chunks/s".format(**result)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of token accounting and truncation on long histories: re-encoding the whole
+conversation per check (previous behaviour) against per-message cached counts.
+
+    python -m benchmarks.bench_token_count --turns 200 --max-tokens 4000
+"""
+import argparse
+import random
+import time
+
+import tiktoken
+
+from helpers.conversation import TOKENS_PER_REPLY, Conversation, count_message_tokens
+
+WORDS = ["python", "discord", "token", "stream", "message", "conversation", "latency", "the", "a", "of"]
+
+
+def make_history(turns: int, words_per_message: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        content = " ".join(rng.choice(WORDS) for _ in range(words_per_message))
+        history.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return history
+
+
+def full_count(encoding, messages: list) -> int:
+    return sum(count_message_tokens(encoding, m) for m in messages) + TOKENS_PER_REPLY
+
+
+def legacy_truncate(encoding, messages: list, max_tokens: int) -> int:
+    checks = 0
+    while True:
+        checks += 1
+        if full_count(encoding, messages) > max_tokens and len(messages) > 1:
+            messages.pop(1)
+        else:
+            break
+    return checks
+
+
+def cached_truncate(conversation: Conversation, max_tokens: int) -> int:
+    checks = 0
+    while conversation.token_count() > max_tokens and len(conversation) > 1:
+        checks += 1
+        conversation.pop(1)
+    return checks + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--words", type=int, default=60)
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    args = parser.parse_args()
+    encoding = tiktoken.get_encoding("cl100k_base")
+    history = make_history(args.turns, args.words)
+
+    # previous: append everything, then re-encode on every truncation check and once more for max_tokens
+    started = time.perf_counter()
+    messages = list(history)
+    checks = legacy_truncate(encoding, messages, args.max_tokens)
+    full_count(encoding, messages)
+    legacy = time.perf_counter() - started
+
+    # cached: each message encoded once when added, checks read the running total
+    started = time.perf_counter()
+    conversation = Conversation()
+    for message in history:
+        conversation.append(message, count_message_tokens(encoding, message))
+    cached_checks = cached_truncate(conversation, args.max_tokens)
+    conversation.token_count()
+    cached = time.perf_counter() - started
+
+    assert conversation.messages == messages
+    print("{} turns, {} kept".format(args.turns, len(messages)))
+    print("re-encode: {:.4f}s ({} checks)".format(legacy, checks))
+    print("cached:    {:.4f}s ({} checks, {:.1f}x faster)".format(cached, cached_checks, legacy / cached))
+
+
+if __name__ == "__main__":
+    main()
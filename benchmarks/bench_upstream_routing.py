@@ -0,0 +1,111 @@
+"""
+Upstream routing against several local mock servers, no network or key needed.
+
+    python -m benchmarks.bench_upstream_routing --requests 300 --concurrency 30
+
+Three OpenAI-compatible mock endpoints: "fast" and "slow" (first chunk after --fast-ttft and
+--slow-ttft seconds) and "broken" (HTTP 500). Phases:
+
+1. steady: traffic should go mostly to fast, nothing should fail, broken's circuit should open
+2. fast rate limited: fast answers 429, its circuit opens and slow takes the traffic
+3. fast recovered: after Retry-After a probe closes fast's circuit again
+
+Prints where requests went in each phase, exits 1 when a phase does not behave as above.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from benchmarks.mock_sse_server import start_server
+from helpers.openai_client import OpenAIClient
+from helpers.upstream import Endpoint, UpstreamPool
+
+
+async def one_request(pool: UpstreamPool) -> bool:
+    json_data = {"model": "mock", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    try:
+        async for _ in pool.stream_chat(json_data):
+            pass
+        return True
+    except Exception:
+        return False
+
+
+async def phase(pool: UpstreamPool, servers: dict, requests: int, concurrency: int) -> dict:
+    before = {name: runner.app["counter"]["requests"] for name, (runner, _) in servers.items()}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited() -> bool:
+        async with semaphore:
+            return await one_request(pool)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[limited() for _ in range(requests)])
+    return {
+        "elapsed": time.perf_counter() - started,
+        "failed": results.count(False),
+        "served": {name: runner.app["counter"]["requests"] - before[name] for name, (runner, _) in servers.items()},
+        "open": [e.name for e in pool.endpoints if e.is_open(time.monotonic())],
+    }
+
+
+def report(name: str, result: dict) -> None:
+    print("{:22} {:5.2f}s failed={:<3d} served={} open={}".format(
+        name, result["elapsed"], result["failed"], result["served"], result["open"]
+    ))
+
+
+async def run(args) -> int:
+    servers = {
+        "fast": await start_server(chunks=args.chunks, delay=0.0, ttft=args.fast_ttft),
+        "slow": await start_server(chunks=args.chunks, delay=0.0, ttft=args.slow_ttft),
+        "broken": await start_server(status=500),
+    }
+    client = OpenAIClient("mock")
+    pool = UpstreamPool(client, [
+        Endpoint(name, url, "mock", max_concurrent=args.max_concurrent) for name, (_, url) in servers.items()
+    ], failure_threshold=3, cooldown=60.0)
+    problems = []
+    try:
+        steady = await phase(pool, servers, args.requests, args.concurrency)
+        report("steady", steady)
+        if steady["failed"] or steady["served"]["fast"] <= steady["served"]["slow"] or "broken" not in steady["open"]:
+            problems.append("steady: expected no failures, fast preferred and broken's circuit open")
+
+        servers["fast"][0].app["state"]["status"] = 429
+        limited = await phase(pool, servers, args.requests, args.concurrency)
+        report("fast rate limited", limited)
+        if limited["failed"] or "fast" not in limited["open"] or limited["served"]["fast"] > args.concurrency:
+            problems.append("rate limited: expected no failures and fast's circuit open")
+
+        servers["fast"][0].app["state"]["status"] = 200
+        # the mock's Retry-After is 1 second
+        await asyncio.sleep(1.1)
+        recovered = await phase(pool, servers, args.requests, args.concurrency)
+        report("fast recovered", recovered)
+        if recovered["failed"] or "fast" in recovered["open"] or recovered["served"]["fast"] <= recovered["served"]["slow"]:
+            problems.append("recovered: expected fast's circuit closed and fast preferred again")
+    finally:
+        await client.close()
+        for runner, _ in servers.values():
+            await runner.cleanup()
+    for problem in problems:
+        print("FAIL", problem)
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--max-concurrent", type=int, default=20, help="per endpoint")
+    parser.add_argument("--chunks", type=int, default=10)
+    parser.add_argument("--fast-ttft", type=float, default=0.01)
+    parser.add_argument("--slow-ttft", type=float, default=0.05)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
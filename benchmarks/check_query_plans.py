@@ -0,0 +1,122 @@
+"""
+Check the query plans of the hot rate-limit and history queries against a local MySQL/MariaDB.
+
+    python -m benchmarks.check_query_plans --host 127.0.0.1 --user root --password secret
+
+Creates a scratch database (chatbot_plan_check by default, never the bot's own), applies the
+migrations, seeds it with synthetic rows so the optimizer has statistics, then runs EXPLAIN on
+every query in cogs/utils.py. Exits 1 when a query scans a table, misses its index, sorts,
+or needs the row where the index should cover it.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+import aiomysql
+from aiomysql.cursors import DictCursor
+
+from cogs.utils import SQL_CONVO_TURNS, SQL_RECENT_CHATS, SQL_RECENT_QUEUES
+from helpers.migrations import migrate
+
+NOW = 1700000000
+# name, sql, parameters, expected index, covering
+CHECKS = [
+    ("get_recent_queues", SQL_RECENT_QUEUES, ("DISCORD", NOW - 60), "server_started_user", True),
+    ("get_recent_chats", SQL_RECENT_CHATS, ("DISCORD", NOW - 24 * 3600), "server_started_user", True),
+    ("get_convo_turns", SQL_CONVO_TURNS, ("1007", 40), "convo_id_id", False),
+]
+
+
+async def seed(cur, rows: int) -> None:
+    await cur.execute("SELECT COUNT(*) AS n FROM `chat_messages`")
+    if (await cur.fetchone())['n'] >= rows:
+        return
+    rng = random.Random(42)
+    users = [str(1000 + i) for i in range(500)]
+    queues, chats, turns = [], [], []
+    for _ in range(rows):
+        user = rng.choice(users)
+        server = "DISCORD" if rng.random() < 0.9 else "TELEGRAM"
+        started = NOW - rng.randint(0, 7 * 24 * 3600)
+        queues.append((user, server, "1", started, "question"))
+        chats.append((user, server, "1", "chatcmpl", user, 3, "question", "{}", "answer", started, started + 3))
+        turns.append((user, rng.choice(("user", "assistant")), "content", 10, started))
+    await cur.executemany(
+        "INSERT INTO `chat_queues` (`user_id`, `user_server`, `guild_id`, `started`, `asked`) VALUES (%s, %s, %s, %s, %s)",
+        queues
+    )
+    await cur.executemany(
+        """
+        INSERT INTO `chat_messages` (`user_id`, `user_server`, `guild_id`, `data_id`, `convo_id`, `time`,
+        `asked`, `raw_response`, `response`, `started`, `finished`)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, chats
+    )
+    await cur.executemany(
+        "INSERT INTO `chat_conversation_turns` (`convo_id`, `role`, `content`, `tokens`, `created`) VALUES (%s, %s, %s, %s, %s)",
+        turns
+    )
+    for table in ("chat_queues", "chat_messages", "chat_conversation_turns"):
+        await cur.execute(f"ANALYZE TABLE `{table}`")
+        await cur.fetchall()
+
+
+def problems(plan: dict, index: str, covering: bool) -> list:
+    found = []
+    extra = plan.get('Extra') or ""
+    if plan.get('type') == "ALL":
+        found.append("full table scan")
+    if plan.get('key') != index:
+        found.append("uses {} instead of {}".format(plan.get('key'), index))
+    if "filesort" in extra:
+        found.append("sorts ({})".format(extra))
+    if covering and "Using index" not in extra:
+        found.append("not index-only ({})".format(extra))
+    return found
+
+
+async def main_async(args) -> int:
+    conn = await aiomysql.connect(
+        host=args.host, port=args.port, user=args.user, password=args.password,
+        cursorclass=DictCursor, autocommit=True
+    )
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}` DEFAULT CHARSET utf8mb4")
+            await conn.select_db(args.database)
+        version = await migrate(conn)
+        async with conn.cursor() as cur:
+            started = time.perf_counter()
+            await seed(cur, args.rows)
+            print(f"schema version {version}, seeded in {time.perf_counter() - started:.1f}s")
+            failed = 0
+            for name, sql, params, index, covering in CHECKS:
+                await cur.execute("EXPLAIN " + sql, params)
+                plan = (await cur.fetchall())[0]
+                found = problems(plan, index, covering)
+                failed += bool(found)
+                print("{:18} {:4} key={} rows={} extra={}{}".format(
+                    name, "FAIL" if found else "ok", plan.get('key'), plan.get('rows'), plan.get('Extra'),
+                    "".join("\n    - " + p for p in found)
+                ))
+            return 1 if failed else 0
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="chatbot_plan_check")
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Local OpenAI-compatible chat completion server streaming canned SSE chunks.
+
+    python -m benchmarks.mock_sse_server --port 8808 --chunks 50 --delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Tuple
+
+from aiohttp import web
+
+
+def make_chunk(data_id: str, delta: dict, finish_reason=None) -> bytes:
+    chunk = {
+        "id": data_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "mock",
+        "choices": [{"delta": delta, "index": 0, "finish_reason": finish_reason}],
+    }
+    return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+
+def make_app(
+    chunks: int = 50, delay: float = 0.02, ttft: float = 0.0, word: str = "token ", status: int = 200
+) -> web.Application:
+    """
+    Build the mock app. Every request streams `chunks` content deltas, `delay` seconds apart,
+    after waiting `ttft` seconds for the first one. Any other `status` than 200 is answered
+    right away with an error body (and Retry-After: 1 for 429). The status can be changed while
+    running through app["state"].
+    """
+    counter = {"requests": 0}
+    state = {"status": status}
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        await request.json()
+        counter["requests"] += 1
+        if state["status"] != 200:
+            headers = {"Retry-After": "1"} if state["status"] == 429 else None
+            return web.json_response({"error": {"message": "mock error"}}, status=state["status"], headers=headers)
+        data_id = "chatcmpl-mock-{}".format(counter["requests"])
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        if ttft:
+            await asyncio.sleep(ttft)
+        await response.write(make_chunk(data_id, {"role": "assistant"}))
+        for _ in range(chunks):
+            await response.write(make_chunk(data_id, {"content": word}))
+            if delay:
+                await asyncio.sleep(delay)
+        await response.write(make_chunk(data_id, {}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app["counter"] = counter
+    app["state"] = state
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 0, **kwargs) -> Tuple[web.AppRunner, str]:
+    """
+    Start the mock server in the running loop, returns the runner and the bound completions URL
+    """
+    runner = web.AppRunner(make_app(**kwargs))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://{}:{}/v1/chat/completions".format(host, bound_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+    web.run_app(
+        make_app(chunks=args.chunks, delay=args.delay, ttft=args.ttft, status=args.status),
+        host=args.host, port=args.port
+    )
+
+
+if __name__ == "__main__":
+    main()
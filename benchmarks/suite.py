@@ -0,0 +1,252 @@
+"""
+Offline micro-benchmarks of the chat hot path, compared against a stored baseline.
+
+    python -m benchmarks.suite                      # run, print JSON, exit 1 on regression
+    python -m benchmarks.suite --only sse_parse     # run a subset
+    python -m benchmarks.suite --update-baseline    # record the current numbers
+
+Every case uses fixed seeds and the recorded fixtures in benchmarks/fixtures, nothing touches
+the network. Token counts use WordEncoding, a stand-in for cl100k_base, so the numbers measure
+the conversation bookkeeping rather than tiktoken itself.
+Each case is reported in seconds and relative to a fixed pure-Python calibration loop timed
+alongside every repeat; the regression check compares the relative numbers so a uniformly slower
+or busier machine does not fail it. Refresh benchmarks/baseline.json after intended performance changes.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.bench_chunker import make_response
+from benchmarks.bench_token_count import make_history
+from helpers.chunker import split_message
+from helpers.conversation import Conversation, count_message_tokens
+from helpers.openai_client import read_events
+from helpers.ratelimit import ChatRateLimiter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures")
+BASELINE = os.path.join(HERE, "baseline.json")
+RATE_LIMITS = {'max_q_per_mn': 5, 'max_use_per_hour': 20, 'max_use_per_day': 100}
+
+
+class WordEncoding:
+    """
+    Deterministic offline tokenizer: one token per word or punctuation mark
+    """
+    name = "words"
+    pattern = re.compile(r"\w+|[^\w\s]")
+
+    def encode(self, text: str) -> list:
+        return self.pattern.findall(text)
+
+
+def case_conversation_append() -> Callable[[], None]:
+    encoding = WordEncoding()
+    history = make_history(2000, 60)
+
+    def run():
+        conversation = Conversation()
+        for message in history:
+            conversation.append(message, count_message_tokens(encoding, message))
+        conversation.token_count()
+    return run
+
+
+def case_conversation_truncate() -> Callable[[], None]:
+    # many conversations of a realistic length rather than one huge one: the work stays in the
+    # interpreter (like the calibration loop) instead of in memmove of a long list
+    encoding = WordEncoding()
+    history = make_history(1000, 60)
+    tokens = [count_message_tokens(encoding, message) for message in history]
+    conversations = []
+    for _ in range(150):
+        conversation = Conversation()
+        for message, count in zip(history, tokens):
+            conversation.append(message, count)
+        conversations.append(conversation)
+
+    def run():
+        for conversation in conversations:
+            while conversation.token_count() > 4000 and len(conversation) > 1:
+                conversation.pop(1)
+    return run
+
+
+def case_sse_parse() -> Callable[[], None]:
+    with open(os.path.join(FIXTURES, "chat_stream.sse"), "rb") as f:
+        payload = f.read()
+    # replay the stream in network-sized reads, boundaries falling anywhere in a line
+    rng = random.Random(42)
+    reads = []
+    offset = 0
+    while offset < len(payload):
+        size = rng.randint(200, 4000)
+        reads.append(payload[offset:offset + size])
+        offset += size
+    loop = asyncio.new_event_loop()
+
+    async def replay():
+        for data in reads:
+            yield data
+
+    async def consume():
+        parts = []
+        async for resp in read_events(replay(), bytearray()):
+            delta = resp["choices"][0]["delta"]
+            if "content" in delta:
+                parts.append(delta["content"])
+        return "".join(parts)
+
+    def run():
+        loop.run_until_complete(consume())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+    return run
+
+
+def case_split_message() -> Callable[[], None]:
+    response = make_response(60000)
+
+    def run():
+        for _ in range(20):
+            split_message(response, 1900)
+    return run
+
+
+def case_ratelimit_check() -> Callable[[], None]:
+    rng = random.Random(42)
+    now = 1700000000
+    limiter = ChatRateLimiter()
+    users = [str(10 ** 17 + i) for i in range(2000)]
+    limiter.warm(
+        [{'user_id': rng.choice(users), 'started': now - rng.randint(0, 59)} for _ in range(5000)],
+        [{'user_id': rng.choice(users), 'started': now - rng.randint(0, 24 * 3600 - 1)} for _ in range(50000)],
+    )
+    keys = [rng.choice(users) for _ in range(20000)]
+
+    def run():
+        for key in keys:
+            limiter.check(key, now, RATE_LIMITS)
+    return run
+
+
+def case_calibration() -> Callable[[], None]:
+    words = make_history(2000, 60)
+
+    def run():
+        table = {}
+        for message in words:
+            for word in message["content"].split():
+                table[word] = table.get(word, 0) + len(word)
+        sorted(table.items())
+    return run
+
+
+CASES: Dict[str, Callable[[], Callable[[], None]]] = {
+    "conversation_append": case_conversation_append,
+    "conversation_truncate": case_conversation_truncate,
+    "sse_parse": case_sse_parse,
+    "split_message": case_split_message,
+    "ratelimit_check": case_ratelimit_check,
+}
+
+
+def timed_run(setup: Callable[[], Callable[[], None]]) -> float:
+    """
+    Wall time of one run on a fresh setup, setup and garbage collection kept outside
+    """
+    run = setup()
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        run()
+        return time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+def measure(setup: Callable[[], Callable[[], None]], repeats: int) -> Tuple[float, float]:
+    """
+    Best wall time of `repeats` runs and the median ratio to a calibration run timed
+    right before each of them
+    """
+    best = float("inf")
+    ratios = []
+    for _ in range(repeats):
+        calibration = timed_run(case_calibration)
+        elapsed = timed_run(setup)
+        best = min(best, elapsed)
+        ratios.append(elapsed / calibration)
+    return best, statistics.median(ratios)
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    regressions = []
+    for name, relative in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name] * (1 + threshold)
+        if relative > limit:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(CASES), help="case to run, repeatable")
+    parser.add_argument("--repeats", type=int, default=9)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown over baseline, 0.25 = 25%%")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    names = args.only or list(CASES)
+    measured = {name: measure(CASES[name], args.repeats) for name in names}
+    seconds = {name: value[0] for name, value in measured.items()}
+    results = {name: value[1] for name, value in measured.items()}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+    regressions = [] if args.update_baseline else compare(results, baseline, args.threshold)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeats": args.repeats,
+        "threshold": args.threshold,
+        "seconds": seconds,
+        "results": results,
+        "baseline": {name: baseline[name] for name in names if name in baseline},
+        "regressions": regressions,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": report["python"], "machine": report["machine"], "results": baseline
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if regressions:
+        print("regressed past {:.0%}: {}".format(args.threshold, ", ".join(regressions)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Run the bot as several worker processes, each owning a contiguous range of shards.
+
+    python cluster.py            # start the coordinator and the workers
+    python cluster.py status     # health of every cluster, as JSON
+    python cluster.py restart    # rolling restart, one cluster at a time (also on SIGHUP)
+
+Settings come from the [cluster] section of config.toml: workers, shard_count (0 asks Discord
+for the recommended count), socket, ready_timeout and stop_timeout.
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+from typing import List, Optional
+
+import aiohttp
+
+from config import load_config
+from helpers.cluster import Coordinator, control, shard_ranges
+
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: List[int]) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started = 0.0
+        self.restarts = 0
+        self.stopping = False
+
+
+class Launcher:
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        cluster = config.get('cluster', {})
+        self.worker_count = cluster.get('workers', 2)
+        self.shard_count = cluster.get('shard_count', 0)
+        self.socket = os.path.abspath(cluster.get('socket', "cluster.sock"))
+        self.ready_timeout = cluster.get('ready_timeout', 300.0)
+        self.stop_timeout = cluster.get('stop_timeout', 30.0)
+        self.coordinator = Coordinator(self.socket, claim_timeout=cluster.get('claim_timeout', 5.0))
+        self.coordinator.on_restart = self.request_restart
+        self.workers: List[Worker] = []
+        self.restarting: Optional[asyncio.Task] = None
+        self.stopped = asyncio.Event()
+
+    async def recommended_shards(self) -> int:
+        headers = {"Authorization": "Bot {}".format(self.config['discord']['token'])}
+        async with aiohttp.ClientSession() as session:
+            async with session.get(GATEWAY_BOT_URL, headers=headers) as response:
+                response.raise_for_status()
+                return (await response.json())['shards']
+
+    async def spawn(self, worker: Worker) -> None:
+        env = dict(
+            os.environ,
+            CHATBOT_CLUSTER_SOCKET=self.socket,
+            CHATBOT_CLUSTER_ID=str(worker.cluster_id),
+            CHATBOT_SHARD_IDS=",".join(str(i) for i in worker.shard_ids),
+            CHATBOT_SHARD_COUNT=str(self.shard_count),
+        )
+        worker.stopping = False
+        # own session: a Ctrl-C on the launcher reaches workers as SIGTERM, once, through stop()
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, "Bot.py", env=env, start_new_session=True
+        )
+        worker.started = time.time()
+        print(f"Cluster {worker.cluster_id} started (pid {worker.process.pid}, shards {worker.shard_ids})")
+        asyncio.create_task(self.supervise(worker, worker.process))
+
+    async def supervise(self, worker: Worker, process: asyncio.subprocess.Process) -> None:
+        """
+        Respawn a worker that exited on its own, backing off when it keeps crashing
+        """
+        code = await process.wait()
+        if worker.stopping or worker.process is not process or self.stopped.is_set():
+            return
+        worker.restarts += 1
+        delay = 5.0 if time.time() - worker.started > 60 else min(60.0, 5.0 * worker.restarts)
+        print(f"Cluster {worker.cluster_id} exited with code {code}, respawning in {delay:.0f}s.")
+        await asyncio.sleep(delay)
+        if not self.stopped.is_set() and worker.process is process:
+            await self.spawn(worker)
+
+    async def stop(self, worker: Worker) -> None:
+        process = worker.process
+        if process is None or process.returncode is not None:
+            return
+        worker.stopping = True
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), self.stop_timeout)
+        except asyncio.TimeoutError:
+            print(f"Cluster {worker.cluster_id} did not stop in {self.stop_timeout}s, killing.")
+            process.kill()
+            await process.wait()
+
+    async def wait_ready(self, worker: Worker) -> bool:
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline and not self.stopped.is_set():
+            report = self.coordinator.health.get(worker.cluster_id)
+            if report is not None and report.get('pid') == worker.process.pid and report.get('ready'):
+                return True
+            if worker.process.returncode is not None:
+                return False
+            await asyncio.sleep(1.0)
+        return False
+
+    async def rolling_restart(self) -> None:
+        for worker in self.workers:
+            if self.stopped.is_set():
+                return
+            print(f"Restarting cluster {worker.cluster_id}...")
+            await self.stop(worker)
+            await self.spawn(worker)
+            if not await self.wait_ready(worker):
+                print(f"Cluster {worker.cluster_id} not ready after restart, rolling restart aborted.")
+                return
+        print("Rolling restart done.")
+
+    def request_restart(self) -> bool:
+        if self.restarting is not None and not self.restarting.done():
+            return False
+        self.restarting = asyncio.create_task(self.rolling_restart())
+        return True
+
+    async def run(self) -> None:
+        if not self.shard_count:
+            self.shard_count = await self.recommended_shards()
+        await self.coordinator.start()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stopped.set)
+        loop.add_signal_handler(signal.SIGTERM, self.stopped.set)
+        loop.add_signal_handler(signal.SIGHUP, self.request_restart)
+        self.workers = [
+            Worker(cluster_id, shard_ids)
+            for cluster_id, shard_ids in enumerate(shard_ranges(self.shard_count, self.worker_count))
+        ]
+        print(f"Launching {len(self.workers)} cluster(s) for {self.shard_count} shard(s)")
+        try:
+            for worker in self.workers:
+                await self.spawn(worker)
+                # let each cluster identify before the next, gateway identifies are rate limited
+                await self.wait_ready(worker)
+            await self.stopped.wait()
+        finally:
+            self.stopped.set()
+            if self.restarting is not None:
+                self.restarting.cancel()
+            await asyncio.gather(*(self.stop(worker) for worker in self.workers), return_exceptions=True)
+            await self.coordinator.close()
+
+
+def main():
+    config = load_config()
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "run":
+        asyncio.run(Launcher(config).run())
+        return
+    socket = os.path.abspath(config.get('cluster', {}).get('socket', "cluster.sock"))
+    if command in ("status", "restart"):
+        try:
+            print(json.dumps(asyncio.run(control(socket, command)), indent=2))
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            sys.exit(1)
+        return
+    print(__doc__)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
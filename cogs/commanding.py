@@ -1,4 +1,5 @@
 from code import interact
+import asyncio
 import discord
 from discord.ext import commands, tasks
 from discord.ext.commands import Greedy, Context
@@ -12,13 +13,37 @@ import time
 import functools
 import json
 import aiohttp
-import tiktoken
-import requests
 from cachetools import TTLCache
 import random
 from cogs.utils import Utils
+from helpers.chunker import split_message
+from helpers.conversation import TOKENS_PER_REPLY, Conversation, ConversationStore, count_message_tokens
+from helpers.metrics import counter, gauge, histogram
+from helpers.openai_client import OpenAIClient, UpstreamError
+from helpers.outbound import outbound
+from helpers.ratelimit import ChatRateLimiter
+from helpers.response_cache import ResponseCache
+from helpers.scheduler import FairScheduler, QueueFull
+from helpers.singleflight import SingleFlight
+from helpers.startup import startup
+from helpers.stream_reply import EditPacer, StreamingReply
+from helpers.summary import SUMMARY_ROLE, build_request, choose_span, first_turn, summary_message
+from helpers.tokenizer import tokenizers
+from helpers.upstream import DeadlineExceeded, UpstreamPool
 
 SERVER_BOT = "DISCORD"
+# scheduler queue of background summaries
+SUMMARY_QUEUE = "summary"
+# shown after an answer stopped at its deadline
+PARTIAL_NOTE = "\n\n*(answer cut short, it took too long)*"
+# stop generating this long before a slash command's interaction token expires
+INTERACTION_MARGIN = 30.0
+
+UPSTREAM_TTFT = histogram("chatbot_upstream_ttft_seconds", "Time from upstream request to first content token")
+UPSTREAM_LATENCY = histogram("chatbot_upstream_seconds", "Upstream completion latency, request to end of stream")
+UPSTREAM_WAIT = histogram("chatbot_upstream_wait_seconds", "Time waited for an upstream slot")
+TOKENS = counter("chatbot_tokens_total", "Tokens sent to and received from upstream")
+RATE_LIMITED = counter("chatbot_rate_limited_total", "Chats rejected by rate limits, by reason")
 
 # Cog class
 class Commanding(commands.Cog):
@@ -27,20 +52,54 @@ class Commanding(commands.Cog):
         self.bot: commands.Bot = bot
         self.utils = Utils(bot)
         self.cache_user_q = TTLCache(maxsize=20000, ttl=60.0)
+        self.rate_limiter = ChatRateLimiter()
 
         self.engine: str = self.bot.config['openai']['engine']
         self.max_tokens = self.bot.config['openai']['ai_max_tokens']
         self.temperature = self.bot.config['openai']['ai_temperature']
         self.system_prompt = "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally"
-        self.session = requests.Session()
-        self.conversation: dict = {
-            "default": [
-                {
-                    "role": "system",
-                    "content": "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally",
-                },
-            ],
-        }
+        self.openai_client = OpenAIClient.from_config(self.bot.config)
+        self.upstream = UpstreamPool.from_config(self.bot.config, self.openai_client)
+        scheduler_config = self.bot.config.get('scheduler', {})
+        self.scheduler = FairScheduler(
+            max_concurrent=scheduler_config.get('max_concurrent', 16),
+            max_queued=scheduler_config.get('max_queued', 500),
+            max_queued_per_guild=scheduler_config.get('max_queued_per_guild', 50),
+            weights=scheduler_config.get('weights'),
+        )
+        self.response_cache = None
+        response_cache_config = self.bot.config.get('response_cache', {})
+        if response_cache_config.get('enable', 0) == 1:
+            self.response_cache = ResponseCache(
+                maxsize=response_cache_config.get('maxsize', 1000),
+                ttl=response_cache_config.get('ttl', 3600.0),
+            )
+        self.inflight = SingleFlight()
+        self.edit_pacer = EditPacer(self.bot.config['discord'].get('stream_edit_interval', 1.0))
+        outbound.configure(
+            rate=self.bot.config['discord'].get('send_rate', 5),
+            per=self.bot.config['discord'].get('send_per', 5.0),
+            limit=self.bot.config['discord']['char_limit'],
+        )
+        tokenizers.configure(
+            self.bot.config['openai'].get('encodings'), self.bot.config['openai'].get('tiktoken_cache_dir')
+        )
+        self.encoding = None
+        conversation_config = self.bot.config.get('conversation', {})
+        self.conversation = ConversationStore(
+            max_entries=conversation_config.get('max_entries', 10000),
+            max_tokens=conversation_config.get('max_tokens', 5000000),
+            idle_ttl=conversation_config.get('idle_ttl', 3600.0),
+        )
+        self.reload_rows = conversation_config.get('reload_rows', 40)
+        summary_config = self.bot.config.get('summary', {})
+        # 0 keeps the plain truncation at ai_max_tokens
+        self.summary_target = summary_config.get('target_tokens', 1500) if summary_config.get('enable', 0) == 1 else 0
+        self.summary_tokens = summary_config.get('max_tokens', 300)
+        # compacting goes down to this fraction of the target, so it does not run on every reply
+        self.summary_low_water = int(self.summary_target * summary_config.get('low_water', 0.6))
+        self.compacting = {}
+        self.mention_tags = None
 
     # steal from: https://github.com/acheong08/ChatGPT/blob/main/src/revChatGPT/V3.py
     def add_to_conversation(
@@ -48,65 +107,74 @@ class Commanding(commands.Cog):
         message: str,
         role: str,
         convo_id: str = "default",
-    ) -> None:
+    ) -> int:
         """
-        Add a message to the conversation
+        Add a message to the conversation, counting its tokens once.
+        Returns the message's token count
         """
-        self.conversation[convo_id].append({"role": role, "content": message})
+        new_message = {"role": role, "content": message}
+        tokens = count_message_tokens(self.encoding, new_message)
+        self.conversation[convo_id].append(new_message, tokens)
+        return tokens
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
         Truncate the conversation
         """
-        while True:
-            if (
-                self.get_token_count(convo_id) > self.max_tokens
-                and len(self.conversation[convo_id]) > 1
-            ):
-                # Don't remove the first message
-                self.conversation[convo_id].pop(1)
-            else:
-                break
+        conversation = self.conversation[convo_id]
+        # Don't remove the first message, nor the summary of older turns
+        first = first_turn(conversation)
+        while conversation.token_count() > self.max_tokens and len(conversation) > first:
+            conversation.pop(first)
 
     def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
         """
         Reset the conversation
         """
-        self.conversation[convo_id] = [
-            {"role": "system", "content": system_prompt or self.system_prompt},
-        ]
+        self.conversation[convo_id] = Conversation()
+        self.add_to_conversation(system_prompt or self.system_prompt, "system", convo_id=convo_id)
+
+    async def load_conversation(self, convo_id: str) -> None:
+        """
+        Rebuild a conversation which is not in memory from its latest persisted turns
+        that fit in ai_max_tokens, using their stored token counts.
+        A summary row has role "summary:<n>": it covers everything before the n turns preceding it.
+        """
+        self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
+        conversation = self.conversation[convo_id]
+        budget = self.max_tokens - conversation.token_count()
+        turns = []
+        summary = None
+        kept = None
+        for row in await self.utils.get_convo_turns(convo_id, self.reload_rows):
+            if kept == 0:
+                break
+            if row['role'].startswith(SUMMARY_ROLE):
+                if summary is not None:
+                    # older summary, superseded by the one already read
+                    continue
+                if row['tokens'] > budget:
+                    break
+                summary = row
+                kept = int(row['role'].partition(":")[2] or 0)
+                budget -= row['tokens']
+                continue
+            if row['tokens'] > budget:
+                break
+            if kept is not None:
+                kept -= 1
+            budget -= row['tokens']
+            turns.append(row)
+        if summary is not None:
+            conversation.append({"role": "system", "content": summary['content']}, summary['tokens'])
+        for row in reversed(turns):
+            conversation.append({"role": row['role'], "content": row['content']}, row['tokens'])
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     def get_token_count(self, convo_id: str = "default") -> int:
         """
         Get token count
         """
-        if self.engine not in [
-            "gpt-3.5-turbo",
-            "gpt-3.5-turbo-0301",
-            "gpt-4",
-            "gpt-4-0314",
-            "gpt-4-32k",
-            "gpt-4-32k-0314",
-        ]:
-            error = NotImplementedError(f"Unsupported engine {self.engine}")
-            raise error
-
-        tiktoken.model.MODEL_PREFIX_TO_ENCODING["gpt-4-"] = "cl100k_base"
-        tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
-
-        encoding = tiktoken.encoding_for_model(self.engine)
-
-        num_tokens = 0
-        for message in self.conversation[convo_id]:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += 1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
+        return self.conversation[convo_id].token_count()
 
     def get_max_tokens(self, convo_id: str) -> int:
         """
@@ -114,37 +182,30 @@ class Commanding(commands.Cog):
         """
         return self.max_tokens - self.get_token_count(convo_id)
 
-    def req_generate_text(self, config, convo_id):
+    async def req_generate_text(self, messages, prompt_tokens, on_delta=None, reply_tokens=None, deadline=None):
+        """
+        Stream a completion, None on failure. Stopped at `deadline` (a loop time, [openai]
+        total_timeout by default): what was received by then is returned with partial set
+        """
         try:
-            url = "https://api.openai.com/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer {}".format(config['openai']['key']),
-            }
             json_data = {
                 "model": self.engine,
-                "messages": self.conversation[convo_id],
+                "messages": messages,
                 "stream": True,
                 "temperature": self.temperature,
                 "n": 1,
                 "user": "user",
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
+                "max_tokens": reply_tokens or self.max_tokens - prompt_tokens,
             }
-            response = self.session.post(
-                url, headers = headers, json = json_data, stream=True
-            )
-            if response.status_code == 200:
-                response_text = response.text
-                response_role: str = None
-                full_response: str = ""
-                data_id = None
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    line = line.decode("utf-8")[6:] # Remove "data: "
-                    if line == "[DONE]":
-                        break
-                    resp = json.loads(line)
+            raw = bytearray()
+            response_role: str = None
+            content_parts = []
+            data_id = None
+            request_started = time.perf_counter()
+            first_token = None
+            partial = False
+            try:
+                async for resp in self.upstream.stream_chat(json_data, raw, deadline):
                     data_id = resp['id']
                     choices = resp.get("choices")
                     if not choices:
@@ -155,19 +216,140 @@ class Commanding(commands.Cog):
                     if "role" in delta:
                         response_role = delta["role"]
                     if "content" in delta:
-                        full_response += delta["content"]
-                self.add_to_conversation(full_response, response_role, convo_id=convo_id)
-                return {
-                    "raw_response": response_text, "response": full_response, "data_id": data_id
-                }
-                # return response_dict["choices"][0]["text"]
-            else:
-                print("req_generate_text got status {}.".format(response.status))
-                print(response)
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                            UPSTREAM_TTFT.observe(first_token - request_started)
+                        content_parts.append(delta["content"])
+                        if on_delta is not None:
+                            on_delta(delta["content"])
+            except DeadlineExceeded as e:
+                print("req_generate_text stopped: {}.".format(e))
+                if not "".join(content_parts).strip():
+                    return None
+                partial = True
+            full_response = "".join(content_parts)
+            reply = {"role": response_role or "assistant", "content": full_response}
+            reply_tokens = count_message_tokens(self.encoding, reply)
+            UPSTREAM_LATENCY.observe(time.perf_counter() - request_started)
+            TOKENS.inc(prompt_tokens, direction="in")
+            TOKENS.inc(reply_tokens, direction="out")
+            return {
+                "raw_response": raw.decode("utf-8", errors="replace"),
+                "response": full_response, "data_id": data_id,
+                "role": reply["role"], "tokens": reply_tokens, "partial": partial
+            }
+        except UpstreamError as e:
+            print("req_generate_text got status {}.".format(e.status))
+            print(e.body)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return None
 
+    async def req_scheduled(self, ticket, messages, prompt_tokens, on_delta, reply_tokens=None, deadline=None):
+        """
+        Wait for the ticket's upstream slot then generate
+        """
+        UPSTREAM_WAIT.observe(await self.scheduler.wait(ticket))
+        try:
+            if deadline is not None and self.bot.loop.time() >= deadline:
+                print("req_scheduled: deadline passed while queued.")
+                return None
+            return await self.req_generate_text(messages, prompt_tokens, on_delta, reply_tokens, deadline)
+        finally:
+            self.scheduler.release()
+
+    async def begin_chat(self, key: str, user: str) -> Optional[str]:
+        """
+        Why the user can't chat now ("in_progress", "minute", "day" or "hour"), None once the
+        chat is queued and marked in progress. The cluster coordinator decides when running as
+        a cluster so the limits hold across processes.
+        """
+        now = int(time.time())
+        if self.bot.cluster is not None:
+            try:
+                exceeded = await self.bot.cluster.begin_chat(user, now, self.bot.config['discord'])
+                if exceeded is None:
+                    self.cache_user_q[key] = now
+                return exceeded
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+        if key in self.cache_user_q and now - self.cache_user_q[key] < 60:
+            return "in_progress"
+        exceeded = self.rate_limiter.check(user, now, self.bot.config['discord'])
+        if exceeded is None:
+            self.rate_limiter.add_queue(user, now)
+            self.cache_user_q[key] = now
+        return exceeded
+
+    async def end_chat(self, key: str, user: str, started: int, answered: bool) -> None:
+        self.cache_user_q.pop(key, None)
+        if self.bot.cluster is not None:
+            try:
+                await self.bot.cluster.end_chat(user, started, answered)
+                return
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+        if answered:
+            self.rate_limiter.add_chat(user, started)
+
+    async def release_conversation(self, convo_id: str) -> bool:
+        """
+        Another cluster takes this conversation over: persist its pending turns, drop our copy
+        """
+        await self.utils.turn_writer.flush()
+        if convo_id in self.conversation:
+            self.conversation.remove(convo_id)
+        return True
+
+    def schedule_compaction(self, convo_id: str, key: str) -> None:
+        """
+        Summarize the oldest turns in the background once the prompt outgrows [summary] target_tokens
+        """
+        if not self.summary_target or convo_id not in self.conversation or convo_id in self.compacting:
+            return
+        if self.conversation[convo_id].token_count() <= self.summary_target:
+            return
+        task = asyncio.create_task(self.compact_conversation(convo_id, key))
+        self.compacting[convo_id] = task
+        task.add_done_callback(lambda _: self.compacting.pop(convo_id, None))
+
+    async def compact_conversation(self, convo_id: str, key: str) -> None:
+        try:
+            conversation = self.conversation[convo_id]
+            span = choose_span(conversation, self.summary_low_water, self.summary_tokens)
+            if span is None:
+                return
+            first, end = span
+            previous = conversation.messages[1] if first == 2 else None
+            turns = conversation.messages[first:end]
+            request = build_request(previous, turns, self.summary_tokens)
+            prompt_tokens = sum(count_message_tokens(self.encoding, m) for m in request) + TOKENS_PER_REPLY
+            try:
+                # background work: queued like any other guild so chats keep their share of slots
+                ticket = self.scheduler.enqueue(SUMMARY_QUEUE)
+            except QueueFull:
+                return
+            get_response = await self.req_scheduled(ticket, request, prompt_tokens, None, self.summary_tokens)
+            if get_response is None or not get_response['response'].strip():
+                return
+            # apply only if those turns are still where they were and no chat is in flight,
+            # otherwise the next reply tries again
+            if key in self.cache_user_q or convo_id not in self.conversation or self.conversation[convo_id] is not conversation:
+                return
+            if previous is not None and conversation.messages[1] is not previous:
+                return
+            if any(a is not b for a, b in zip(conversation.messages[first:end], turns)) or len(conversation) < end:
+                return
+            summary = summary_message(get_response['response'])
+            tokens = count_message_tokens(self.encoding, summary)
+            conversation.replace(1, end, summary, tokens)
+            self.conversation.update(convo_id)
+            await self.utils.insert_convo_turn(
+                convo_id, "{}:{}".format(SUMMARY_ROLE, len(conversation) - 2), summary['content'], tokens
+            )
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+
     async def send_message(self, message, user_message):
         started = int(time.time())
         author = message.author.id
@@ -175,42 +357,29 @@ class Commanding(commands.Cog):
         convo_id = str(author) # id
         reply_loading = None
 
-        # check if in cache
+        # check in-progress and rate limits
         key = str(author) + "_" + SERVER_BOT
-        if key in self.cache_user_q and int(time.time()) - self.cache_user_q[key] < 60:
-            await message.channel.send(
-                content=f"<@{str(author)}>, 🔴 you have too recent queue in progress. Wait until it finishes!"
+        exceeded = await self.begin_chat(key, str(author))
+        if exceeded is not None:
+            RATE_LIMITED.inc(reason=exceeded)
+        if exceeded == "in_progress":
+            await outbound.send(
+                message.channel, [f"<@{str(author)}>, 🔴 you have too recent queue in progress. Wait until it finishes!"], merge=True
             )
             return
-        # end of cache
-
-        # check q
-        check_q = await self.utils.get_user_queue(
-            author, SERVER_BOT, 60
-        )
-        if check_q >= self.bot.config['discord']['max_q_per_mn']:
-            await message.channel.send(
-                content=f"<@{str(author)}>, you have a lot of queries per last minute. Cool down!"
+        elif exceeded == "minute":
+            await outbound.send(
+                message.channel, [f"<@{str(author)}>, you have a lot of queries per last minute. Cool down!"], merge=True
             )
             return
-
-        # check q
-        check_q = await self.utils.get_user_chats(
-            author, SERVER_BOT, 24*3600
-        )
-        if check_q >= self.bot.config['discord']['max_use_per_day']:
-            await message.channel.send(
-                content=f"<@{str(author)}>, you have a lot of queries per 24h. Do more tomorrow!"
+        elif exceeded == "day":
+            await outbound.send(
+                message.channel, [f"<@{str(author)}>, you have a lot of queries per 24h. Do more tomorrow!"], merge=True
             )
             return
-
-        # check q
-        check_q = await self.utils.get_user_chats(
-            author, SERVER_BOT, 3600
-        )
-        if check_q >= self.bot.config['discord']['max_use_per_hour']:
-            await message.channel.send(
-                content=f"<@{str(author)}>, you have a lot of queries per last hour. Try again later!"
+        elif exceeded == "hour":
+            await outbound.send(
+                message.channel, [f"<@{str(author)}>, you have a lot of queries per last hour. Try again later!"], merge=True
             )
             return
 
@@ -223,24 +392,124 @@ class Commanding(commands.Cog):
             if hasattr(message, "response"):
                 await message.response.defer()
             else:
-                reply_loading = await message.reply(f"<@{str(author)}>, checking ⏳\n> {discord.utils.escape_markdown(user_message)}")
+                loading = f"<@{str(author)}>, checking ⏳\n> {discord.utils.escape_markdown(user_message)}"
+                if isinstance(message, discord.Message):
+                    reply_loading = (await outbound.send(message.channel, [loading], reference=message))[0]
+                else:
+                    # command context: its reply answers the slash interaction
+                    reply_loading = await outbound.paced(message.channel, "reply", message.reply, loading)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
+
+        # another cluster may have served this conversation since, its copy here is stale
+        if self.bot.cluster is not None:
+            try:
+                if await self.bot.cluster.claim(convo_id) and convo_id in self.conversation:
+                    self.conversation.remove(convo_id)
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+
         # Make conversation if it doesn't exist
-        self.cache_user_q[key] = int(time.time())
-        if convo_id not in self.conversation:
-            self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(user_message, "user", convo_id=convo_id)
+        if self.conversation.lookup(convo_id) is None:
+            await self.load_conversation(convo_id)
+
+        # the answer has to arrive within [openai] total_timeout, and before the interaction
+        # token expires for slash commands, otherwise what arrived by then is sent
+        deadline = self.bot.loop.time() + self.upstream.total_timeout
+        interaction = getattr(message, "interaction", None)
+        if isinstance(interaction, discord.Interaction):
+            remaining = (interaction.expires_at - discord.utils.utcnow()).total_seconds() - INTERACTION_MARGIN
+            deadline = min(deadline, self.bot.loop.time() + remaining)
+
+        # one-shot question on a fresh conversation (system prompt only): answered from cache
+        # when enabled, or shared with an identical request already in flight
+        fresh_key = None
+        get_response = None
+        if len(self.conversation[convo_id]) == 1:
+            fresh_key = ResponseCache.make_key(
+                self.engine, self.temperature, self.system_prompt, user_message
+            )
+            if self.response_cache is not None:
+                get_response = self.response_cache.get(fresh_key)
+
+        flight = None
+        ticket = None
+        if get_response is None:
+            flight = self.inflight.get(fresh_key)
+        if get_response is None and flight is None:
+            # wait for an upstream slot, rejected before the conversation is touched
+            try:
+                ticket = self.scheduler.enqueue(message.guild.id)
+            except QueueFull:
+                RATE_LIMITED.inc(reason="queue_full")
+                rejected = f"<@{str(author)}>, 🔴 too many queries in progress. Try again in a moment!"
+                try:
+                    if reply_loading is not None:
+                        await outbound.edit(reply_loading, rejected)
+                    else:
+                        await outbound.send(message.channel, [rejected], merge=True)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stdout)
+                await self.end_chat(key, str(author), started, False)
+                return
+
+        user_tokens = self.add_to_conversation(user_message, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
-        get_answer = functools.partial(
-            self.req_generate_text, self.bot.config, convo_id=convo_id
-        )
-        get_response = await self.bot.loop.run_in_executor(None, get_answer)
+
+        if ticket is not None:
+            if ticket.position > 0:
+                try:
+                    queued = f"<@{str(author)}>, queued, position {ticket.position} ⏳\n> {discord.utils.escape_markdown(user_message)}"
+                    if reply_loading is not None:
+                        await outbound.edit(reply_loading, queued)
+                    else:
+                        await outbound.send(message.channel, [queued], merge=True)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stdout)
+            flight = self.inflight.start(fresh_key, functools.partial(
+                self.req_scheduled, ticket, list(self.conversation[convo_id].messages),
+                self.get_token_count(convo_id=convo_id), deadline=deadline
+            ))
+
+        streaming = None
+        if self.bot.config['discord'].get('stream_reply', 0) == 1:
+            streaming = StreamingReply(
+                message.channel, response, self.bot.config['discord']['char_limit'],
+                self.edit_pacer, reply_loading
+            )
+            streaming.start()
+        if get_response is not None:
+            if streaming is not None:
+                streaming.feed(get_response['response'])
+        else:
+            try:
+                get_response = await self.inflight.wait(
+                    flight, on_delta=streaming.feed if streaming is not None else None
+                )
+            except asyncio.CancelledError:
+                # the upstream request is cancelled with its last waiter, see SingleFlight
+                if streaming is not None:
+                    streaming.cancel()
+                await self.end_chat(key, str(author), started, False)
+                raise
+            if get_response is not None and fresh_key is not None and self.response_cache is not None \
+                    and not get_response.get('partial'):
+                self.response_cache.put(fresh_key, get_response)
+        # may have been evicted meanwhile, it reloads with this turn once persisted
+        if get_response is not None and convo_id in self.conversation:
+            self.conversation[convo_id].append(
+                {"role": get_response['role'], "content": get_response['response']}, get_response['tokens']
+            )
+        if streaming is not None:
+            if get_response is not None and get_response.get('partial'):
+                streaming.feed(PARTIAL_NOTE)
+            await streaming.finish()
+        self.conversation.update(convo_id)
         if get_response is None:
-            await message.channel.send(
-                content=f"<@{str(author)}>, error during fetching query. Try again later!"
+            await outbound.send(
+                message.channel, [f"<@{str(author)}>, error during fetching query. Try again later!"], merge=True
             )
-            del self.cache_user_q[key]
+            await self.end_chat(key, str(author), started, False)
             return
         else:
             finished = int(time.time())
@@ -249,47 +518,28 @@ class Commanding(commands.Cog):
                 get_response['raw_response'], get_response['response'], started, finished,
                 str(message.guild.id)
             )
+            await self.utils.insert_convo_turn(convo_id, "user", user_message, user_tokens)
+            await self.utils.insert_convo_turn(
+                convo_id, get_response['role'], get_response['response'], get_response['tokens']
+            )
+            if streaming is not None:
+                # answer is already shown, edited in place while streaming
+                await self.end_chat(key, str(author), started, True)
+                self.schedule_compaction(convo_id, key)
+                return
 
             if reply_loading is not None:
                 await reply_loading.delete()
             response = f"{response}{get_response['response']}"
-            char_limit = self.bot.config['discord']['char_limit']
-            if len(response) > char_limit:
-                # Split the response into smaller chunks of no more than 1900 characters each(Discord limit is 2000 per chunk)
-                if "```" in response:
-                    # Split the response if the code block exists
-                    parts = response.split("```")
-                    for i in range(len(parts)):
-                        if i%2 == 0: # indices that are even are not code blocks
-                            await message.channel.send(parts[i])
-                        else: # Odd-numbered parts are code blocks
-                            code_block = parts[i].split("\n")
-                            formatted_code_block = ""
-                            for line in code_block:
-                                while len(line) > char_limit:
-                                    # Split the line at the 50th character
-                                    formatted_code_block += line[:char_limit] + "\n"
-                                    line = line[char_limit:]
-                                formatted_code_block += line + "\n"  # Add the line and seperate with new line
-
-                            # Send the code block in a separate message
-                            if (len(formatted_code_block) > char_limit+100):
-                                code_block_chunks = [formatted_code_block[i:i+char_limit]
-                                                    for i in range(0, len(formatted_code_block), char_limit)]
-                                for chunk in code_block_chunks:
-                                    await message.channel.send(f"```{chunk}```")
-                            else:
-                                await message.channel.send(f"```{formatted_code_block}```")
-                else:
-                    response_chunks = [response[i:i+char_limit] for i in range(0, len(response), char_limit)]
-                    for chunk in response_chunks:
-                        try:
-                            await message.channel.send(chunk)
-                        except Exception as e:
-                            traceback.print_exc(file=sys.stdout)
-            else:
-                await message.channel.send(response)
-        del self.cache_user_q[key]
+            if get_response.get('partial'):
+                response += PARTIAL_NOTE
+            try:
+                # queued as one reply: its chunks are not interleaved with other replies to the channel
+                await outbound.send(message.channel, split_message(response, self.bot.config['discord']['char_limit']))
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+        await self.end_chat(key, str(author), started, True)
+        self.schedule_compaction(convo_id, key)
 
     @app_commands.guild_only()
     @commands.hybrid_command(
@@ -309,19 +559,23 @@ class Commanding(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author == self.bot.user:
-            return
-        else:
-            if not hasattr(message, "guild"):
-                return
-            # if not public
-            if self.bot.config['discord']['is_private'] == 1 and message.author.id not in self.bot.config['discord']['testers']:
-                return
-            if str(message.content).split(" ")[1].lower() in ["reload", "load", "donate", "sync"]:
+        # cheapest checks first: most messages don't mention the bot
+        content = message.content
+        if self.mention_tags is None:
+            self.mention_tags = (f"<@{self.bot.user.id}>", f"<@!{self.bot.user.id}>")
+        if self.mention_tags[0] not in content and self.mention_tags[1] not in content:
+            # a reply pinging the bot carries the mention in the payload only
+            if message.reference is None or not any(user.id == self.bot.user.id for user in message.mentions):
                 return
-            if not self.bot.user.mentioned_in(message):
-                return
-            await self.send_message(message, str(message.content))
+        if message.author.bot or message.guild is None:
+            return
+        # if not public
+        if self.bot.config['discord']['is_private'] == 1 and message.author.id not in self.bot.config['discord']['testers']:
+            return
+        # "@bot <command>" is handled by the command itself, not answered as a chat
+        if (await self.bot.get_context(message)).valid:
+            return
+        await self.send_message(message, content)
 
     @app_commands.guild_only()
     @commands.hybrid_command(
@@ -371,16 +625,77 @@ class Commanding(commands.Cog):
         statuses = ["Starts with /", "With /chat", "Brought by WrkzCoin"]
         await self.bot.change_presence(activity=discord.Game(random.choice(statuses)))
 
+    @tasks.loop(minutes=10.0)
+    async def prune_rate_limiter(self) -> None:
+        self.rate_limiter.prune(int(time.time()))
+
     @commands.Cog.listener()
     async def on_ready(self):
         pass
 
+    def register_metrics(self) -> None:
+        """
+        Point the scrape-time gauges at this cog instance
+        """
+        gauge(
+            "chatbot_conversation_store", "Conversation store size and lookups",
+            lambda: [({"stat": k}, v) for k, v in self.conversation.stats().items()]
+        )
+        gauge(
+            "chatbot_scheduler", "Upstream scheduler slots, queue depth and wait time",
+            lambda: [({"stat": k}, v) for k, v in self.scheduler.stats().items()]
+        )
+        gauge(
+            "chatbot_response_cache", "Response cache size and lookups",
+            lambda: [({"stat": k}, v) for k, v in self.response_cache.stats().items()]
+            if self.response_cache is not None else []
+        )
+        gauge(
+            "chatbot_upstream_endpoints", "Upstream endpoints requests in flight, latency average and open circuit",
+            self.upstream.stats
+        )
+        gauge(
+            "chatbot_send_queue_depth", "Messages waiting in the outbound queue, per channel with a backlog",
+            lambda: [({"channel": str(channel_id)}, depth) for channel_id, depth in outbound.depth().items()]
+        )
+
     async def cog_load(self) -> None:
+        self.register_metrics()
+        # BPE ranks may come from disk or network, keep it off the event loop
+        with startup.stage("tokenizer"):
+            tokenizers.apply_cache_dir()
+            self.encoding = await self.bot.loop.run_in_executor(None, tokenizers.get, self.engine)
+        self.reset(convo_id="default", system_prompt=self.system_prompt)
+        with startup.stage("db_pool"):
+            await self.utils.open_connection()
+        await self.utils.migrate()
+        if self.bot.cluster is not None:
+            # limits are kept by the coordinator, loaded by the first cluster to start
+            self.bot.cluster.on("release", self.release_conversation)
+            if not await self.bot.cluster.call("limiter_ready"):
+                await self.bot.cluster.warm(
+                    await self.utils.get_recent_queues(SERVER_BOT, 60),
+                    await self.utils.get_recent_chats(SERVER_BOT, 24*3600)
+                )
+        else:
+            self.rate_limiter.warm(
+                await self.utils.get_recent_queues(SERVER_BOT, 60),
+                await self.utils.get_recent_chats(SERVER_BOT, 24*3600)
+            )
+        await self.openai_client.open()
         if not self.status_task.is_running():
             self.status_task.start()
+        if not self.prune_rate_limiter.is_running():
+            self.prune_rate_limiter.start()
 
     async def cog_unload(self) -> None:
         self.status_task.cancel()
+        self.prune_rate_limiter.cancel()
+        for task in list(self.compacting.values()):
+            task.cancel()
+        await self.utils.flush_writers()
+        await outbound.close()
+        await self.openai_client.close()
 
 
 async def setup(bot: commands.Bot) -> None:
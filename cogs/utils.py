@@ -5,6 +5,33 @@ import traceback, sys
 import aiomysql
 from aiomysql.cursors import DictCursor
 import time
+from typing import List
+
+from helpers.metrics import histogram, timed
+from helpers.outbound import outbound
+from helpers.permissions import BAN_MEMBERS, MANAGE_CHANNELS, MANAGE_MESSAGES, permissions
+from helpers import migrations
+from helpers.logsink import LogSink
+from helpers.writebehind import WriteBehind
+
+MYSQL_LATENCY = histogram("chatbot_mysql_query_seconds", "MySQL query latency per Utils method")
+
+# hot read queries, also checked by benchmarks/check_query_plans.py against the migrated schema
+SQL_RECENT_QUEUES = """
+SELECT `user_id`, `started` FROM `chat_queues`
+WHERE `user_server`=%s AND `started`>%s
+ORDER BY `started` ASC
+"""
+SQL_RECENT_CHATS = """
+SELECT `user_id`, `started` FROM `chat_messages`
+WHERE `user_server`=%s AND `started`>%s
+ORDER BY `started` ASC
+"""
+SQL_CONVO_TURNS = """
+SELECT `role`, `content`, `tokens` FROM `chat_conversation_turns`
+WHERE `convo_id`=%s
+ORDER BY `id` DESC LIMIT %s
+"""
 
 
 def check_regex(given: str):
@@ -21,58 +48,95 @@ class Utils(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot: commands.Bot = bot
         self.db_pool = None
+        mysql = self.bot.config['mysql']
+        writer_options = dict(
+            flush_rows=mysql.get('flush_rows', 50),
+            flush_interval=mysql.get('flush_interval', 1.0),
+            max_buffer=mysql.get('max_buffer', 5000),
+        )
+        self.queue_writer = WriteBehind(self.insert_queue_chats, "chat_queues", **writer_options)
+        self.chat_writer = WriteBehind(self.insert_chat_msgs, "chat_messages", **writer_options)
+        self.turn_writer = WriteBehind(self.insert_convo_turns, "chat_conversation_turns", **writer_options)
+        discord_config = self.bot.config['discord']
+        self.log_sink = LogSink(
+            self.send_log, window=discord_config.get('log_window', 2.0),
+            max_pending=discord_config.get('log_max_pending', 200)
+        )
 
     async def open_connection(self):
         try:
             if self.db_pool is None:
+                mysql = self.bot.config['mysql']
                 self.db_pool = await aiomysql.create_pool(
-                    host=self.bot.config['mysql']['host'], port=3306, minsize=1, maxsize=2,
-                    user=self.bot.config['mysql']['user'], password=self.bot.config['mysql']['password'],
-                    db=self.bot.config['mysql']['db'], cursorclass=DictCursor, autocommit=True
+                    host=mysql['host'], port=mysql.get('port', 3306),
+                    minsize=mysql.get('pool_min', 1), maxsize=mysql.get('pool_max', 10),
+                    user=mysql['user'], password=mysql['password'], db=mysql['db'],
+                    connect_timeout=mysql.get('connect_timeout', 10), pool_recycle=mysql.get('pool_recycle', 3600),
+                    cursorclass=DictCursor, autocommit=True
                 )
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
     async def log_to_channel(self, channel_id: int, content: str) -> None:
+        """
+        Queue a log line, lines for the same channel are sent together (see helpers/logsink.py)
+        """
         try:
-            channel = self.bot.get_channel(channel_id)
-            if channel:
-                try:
-                    await channel.send(content)
-                except Exception as e:
-                    traceback.print_exc(file=sys.stdout)
+            self.log_sink.put(channel_id, content)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
 
+    async def send_log(self, channel_id: int, content: str) -> None:
+        channel = self.bot.get_channel(channel_id)
+        if channel:
+            await outbound.send(channel, [content], merge=True)
+
+    async def resolve_member(self, guild, user):
+        """
+        Member of `guild` from a Member (message.author, interaction.user), a user or an id.
+        Without the members intent only the bot and message authors come with their roles,
+        other ids are fetched from the API when not cached.
+        """
+        if isinstance(user, discord.Member) and user.guild.id == guild.id:
+            return user
+        user_id = getattr(user, "id", user)
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                return None
+        return member
+
     async def get_bot_perm(self, guild):
         try:
-            get_bot_user = guild.get_member(self.bot.user.id)
-            return dict(get_bot_user.guild_permissions)
+            get_bot_user = guild.me
+            if get_bot_user is not None:
+                return dict(discord.Permissions(permissions.value(get_bot_user)))
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def get_user_perms(self, guild, user_id):
+    async def get_user_perms(self, guild, user):
         try:
-            get_user = guild.get_member(user_id)
-            return dict(get_user.guild_permissions)
+            get_user = await self.resolve_member(guild, user)
+            if get_user is not None:
+                return dict(discord.Permissions(permissions.value(get_user)))
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def is_managed_message(self, guild, user_id):
+    async def is_managed_message(self, guild, user):
         try:
-            get_user = guild.get_member(user_id)
-            check_perm = dict(get_user.guild_permissions)
-            if check_perm and (check_perm['manage_channels'] is True) or \
-                (check_perm['manage_messages'] is True):
-                return True
+            return permissions.has_any(await self.resolve_member(guild, user), MANAGE_CHANNELS | MANAGE_MESSAGES)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return False
 
-    async def is_moderator(self, guild, user_id):
+    async def is_moderator(self, guild, user):
         """
+        `user` is best the Member at hand (message.author, interaction.user), an id also works
+
         Sample permission dict
         {
             'create_instant_invite': True,
@@ -118,77 +182,80 @@ class Utils(commands.Cog):
             'moderate_members': False}
         """
         try:
-            get_user = guild.get_member(user_id)
-            check_perm = dict(get_user.guild_permissions)
-            if check_perm and (check_perm['manage_channels'] is True) or \
-                (check_perm['ban_members'] is True):
-                return True
+            return permissions.has_any(await self.resolve_member(guild, user), MANAGE_CHANNELS | BAN_MEMBERS)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return False
 
-    async def get_user_queue(
-        self, user_id: str, user_server: str, duration: int=3600
+    async def insert_queue_chat(
+        self, user_id: str, user_server: str, asked: str, guild_id: int
     ):
+        await self.queue_writer.put((user_id, user_server, guild_id, int(time.time()), asked))
+        return True
+
+    @timed(MYSQL_LATENCY)
+    async def insert_queue_chats(self, rows: List[tuple]):
         try:
-            lap_duration = int(time.time()) - duration
             await self.open_connection()
             async with self.db_pool.acquire() as conn:
                 async with conn.cursor() as cur:
                     sql = """
-                    SELECT COUNT(*) AS q FROM `chat_queues`
-                    WHERE `user_id`=%s AND `user_server`=%s AND `started`>%s
+                    INSERT INTO `chat_queues` (`user_id`, `user_server`, `guild_id`, `started`, `asked`)
+                    VALUES (%s, %s, %s, %s, %s);
                     """
-                    await cur.execute(sql, (user_id, user_server, lap_duration))
-                    result = await cur.fetchone()
-                    if result:
-                        return result['q']
+                    await cur.executemany(sql, rows)
+                    await conn.commit()
+                    return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return False
 
-    async def insert_queue_chat(
-        self, user_id: str, user_server: str, asked: str, guild_id: int
+    @timed(MYSQL_LATENCY)
+    async def get_recent_queues(
+        self, user_server: str, duration: int=60
     ):
         try:
+            lap_duration = int(time.time()) - duration
             await self.open_connection()
             async with self.db_pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """
-                    INSERT INTO `chat_queues` (`user_id`, `user_server`, `guild_id`, `started`, `asked`)
-                    VALUES (%s, %s, %s, %s, %s);
-                    """
-                    await cur.execute(sql, (user_id, user_server, guild_id, int(time.time()), asked))
-                    await conn.commit()
-                    return True
+                    await cur.execute(SQL_RECENT_QUEUES, (user_server, lap_duration))
+                    result = await cur.fetchall()
+                    if result:
+                        return result
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return False
+        return []
 
-    async def get_user_chats(
-        self, user_id: str, user_server: str, duration: int=3600
+    @timed(MYSQL_LATENCY)
+    async def get_recent_chats(
+        self, user_server: str, duration: int=24*3600
     ):
         try:
             lap_duration = int(time.time()) - duration
             await self.open_connection()
             async with self.db_pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """
-                    SELECT COUNT(*) AS q FROM `chat_messages`
-                    WHERE `user_id`=%s AND `user_server`=%s AND `started`>%s
-                    """
-                    await cur.execute(sql, (user_id, user_server, lap_duration))
-                    result = await cur.fetchone()
+                    await cur.execute(SQL_RECENT_CHATS, (user_server, lap_duration))
+                    result = await cur.fetchall()
                     if result:
-                        return result['q']
+                        return result
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return []
 
     async def insert_chat_msg(
         self, user_id: str, user_server: str, data_id: str, convo_id: str, asked: str, 
         raw_response: str, response: str, started: int, finished: int, guild_id: str
     ):
+        await self.chat_writer.put((
+            user_id, user_server, guild_id, data_id, convo_id, finished - started,
+            asked, raw_response, response, started, finished
+        ))
+        return True
+
+    @timed(MYSQL_LATENCY)
+    async def insert_chat_msgs(self, rows: List[tuple]):
         try:
             await self.open_connection()
             async with self.db_pool.acquire() as conn:
@@ -199,25 +266,115 @@ class Utils(commands.Cog):
                     `started`, `finished`)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
                     """
-                    await cur.execute(sql, (
-                        user_id, user_server, guild_id, data_id, convo_id, finished - started,
-                        asked, raw_response, response, started, finished
-                    ))
+                    await cur.executemany(sql, rows)
+                    await conn.commit()
+                    return True
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    @timed(MYSQL_LATENCY)
+    async def migrate(self):
+        """
+        Bring the schema to the latest version, see helpers/migrations.py
+        """
+        try:
+            await self.open_connection()
+            async with self.db_pool.acquire() as conn:
+                await migrations.migrate(conn)
+                return True
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def insert_convo_turn(
+        self, convo_id: str, role: str, content: str, tokens: int
+    ):
+        await self.turn_writer.put((convo_id, role, content, tokens, int(time.time())))
+        return True
+
+    @timed(MYSQL_LATENCY)
+    async def insert_convo_turns(self, rows: List[tuple]):
+        try:
+            await self.open_connection()
+            async with self.db_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """
+                    INSERT INTO `chat_conversation_turns` (`convo_id`, `role`, `content`, `tokens`, `created`)
+                    VALUES (%s, %s, %s, %s, %s);
+                    """
+                    await cur.executemany(sql, rows)
                     await conn.commit()
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return False
 
+    @timed(MYSQL_LATENCY)
+    async def get_convo_turns(
+        self, convo_id: str, limit: int=40
+    ):
+        """
+        Latest turns of a conversation, newest first
+        """
+        try:
+            await self.open_connection()
+            async with self.db_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(SQL_CONVO_TURNS, (convo_id, limit))
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def flush_writers(self) -> None:
+        """
+        Write every buffered row and send pending log lines, used on unload/shutdown
+        """
+        await self.queue_writer.close()
+        await self.chat_writer.close()
+        await self.turn_writer.close()
+        await self.log_sink.close()
+
     @commands.Cog.listener()
     async def on_ready(self):
         pass
 
+    # permission snapshots: drop whatever an update may have changed
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            permissions.invalidate_member(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        permissions.invalidate_member(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.permissions != after.permissions:
+            permissions.invalidate_guild(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        permissions.invalidate_guild(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            permissions.invalidate_guild(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        permissions.invalidate_guild(guild.id)
+
     async def cog_load(self) -> None:
         pass
 
     async def cog_unload(self) -> None:
-        pass
+        await self.flush_writers()
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(Utils(bot))
\ No newline at end of file
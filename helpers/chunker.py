@@ -0,0 +1,96 @@
+from typing import List
+
+FENCE = "```"
+
+
+def split_long_line(line: str, size: int, in_code: bool) -> List[str]:
+    """
+    Cut a line longer than `size`; prose is cut after the last space of each piece when there is one
+    """
+    pieces = []
+    while len(line) > size:
+        cut = size
+        if not in_code:
+            space = line.rfind(" ", size // 2, size)
+            if space > 0:
+                cut = space + 1
+        pieces.append(line[:cut])
+        line = line[cut:]
+    if line:
+        pieces.append(line)
+    return pieces
+
+
+def split_message(text: str, limit: int) -> List[str]:
+    """
+    Pack text into as few messages of at most `limit` characters as possible, in one pass over
+    its lines. A code block cut between two messages is closed at the end of the first and
+    reopened, with its language tag, at the start of the next. Empty messages are never produced.
+    """
+    if len(text) <= limit:
+        return [text] if text.strip() else []
+    chunks: List[str] = []
+    parts: List[str] = []
+    length = 0
+    # opening fence line of the code block we are in, "" outside code
+    fence = ""
+    # the chunk ends with an opening fence and nothing inside the block yet
+    fence_only = False
+
+    def close_chunk() -> None:
+        nonlocal parts, length, fence_only
+        if fence and fence_only:
+            # don't leave an empty block behind, it is reopened in the next chunk
+            parts.pop()
+        elif fence:
+            if not parts[-1].endswith("\n"):
+                parts.append("\n")
+            parts.append(FENCE)
+        chunk = "".join(parts)
+        if chunk.strip():
+            chunks.append(chunk)
+        parts = []
+        length = 0
+        if fence:
+            parts.append(fence + "\n")
+            length = len(fence) + 1
+            fence_only = True
+
+    def add(piece: str) -> None:
+        nonlocal length
+        parts.append(piece)
+        length += len(piece)
+
+    for line in text.splitlines(keepends=True):
+        # a one-line block (```code```) opens nothing
+        is_fence = line.lstrip().startswith(FENCE) and line.count(FENCE) < 2
+        # room kept to close the code block if the chunk is cut inside it
+        reserve = len(FENCE) + 1 if fence and not is_fence else 0
+        if length + len(line) + reserve > limit:
+            close_chunk()
+            if length + len(line) + reserve > limit:
+                size = max(limit - length - reserve, 1)
+                for piece in split_long_line(line, size, bool(fence)):
+                    if length + len(piece) + reserve > limit:
+                        close_chunk()
+                        if not piece.strip():
+                            # a line break left alone at the start of a message
+                            continue
+                    add(piece)
+                    fence_only = False
+                continue
+        if is_fence and fence_only:
+            # closing a block with nothing in it (e.g. reopened right before its end), drop both fences
+            length -= len(parts.pop())
+            fence = ""
+            fence_only = False
+            continue
+        if is_fence:
+            fence = "" if fence else line.strip()
+            fence_only = bool(fence)
+        else:
+            fence_only = False
+        add(line)
+    if parts:
+        close_chunk()
+    return chunks
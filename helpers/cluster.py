@@ -0,0 +1,406 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from helpers.ratelimit import ChatRateLimiter
+
+IN_PROGRESS_TTL = 60
+
+
+def shard_ranges(shard_count: int, workers: int) -> List[List[int]]:
+    """
+    Split shard ids into `workers` contiguous ranges, sizes differing by one at most
+    """
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def send_line(writer: asyncio.StreamWriter, payload: dict) -> None:
+    writer.write(json.dumps(payload).encode("utf-8") + b"\n")
+    await writer.drain()
+
+
+class WorkerConnection:
+    """
+    Coordinator side of one worker process connection
+    """
+    def __init__(self, cluster_id: int, writer: asyncio.StreamWriter) -> None:
+        self.cluster_id = cluster_id
+        self.writer = writer
+        self.pushes: Dict[int, asyncio.Future] = {}
+        self.next_push = 0
+
+    async def push(self, op: str, timeout: float, **kwargs):
+        self.next_push += 1
+        push_id = self.next_push
+        future = asyncio.get_running_loop().create_future()
+        self.pushes[push_id] = future
+        try:
+            await send_line(self.writer, {"push": push_id, "op": op, **kwargs})
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pushes.pop(push_id, None)
+
+
+class Coordinator:
+    """
+    State shared by the worker processes of a cluster, served on a unix socket with
+    newline-delimited JSON: the chat rate limits and in-progress markers, which cluster holds
+    each conversation in memory, and the latest health report of every cluster.
+    Runs in the launcher process, a single event loop so every operation is atomic.
+    """
+    def __init__(self, path: str, claim_timeout: float = 5.0, owner_ttl: float = 24 * 3600.0) -> None:
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.owner_ttl = owner_ttl
+        self.rate_limiter = ChatRateLimiter()
+        self.in_progress: Dict[str, int] = {}
+        self.owners: Dict[str, list] = {}
+        self.workers: Dict[int, WorkerConnection] = {}
+        self.health: Dict[int, dict] = {}
+        self.on_restart: Optional[Callable[[], bool]] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self.prune_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path, limit=2 ** 24)
+        self.prune_task = asyncio.create_task(self.prune_loop())
+
+    async def close(self) -> None:
+        if self.prune_task is not None:
+            self.prune_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            for writer in self.connections.values():
+                writer.close()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def prune_loop(self) -> None:
+        while True:
+            await asyncio.sleep(600)
+            now = int(time.time())
+            self.rate_limiter.prune(now)
+            for key in [k for k, v in self.in_progress.items() if now - v >= IN_PROGRESS_TTL]:
+                del self.in_progress[key]
+            for convo_id in [k for k, v in self.owners.items() if now - v[1] > self.owner_ttl]:
+                del self.owners[convo_id]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = None
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if "push" in request:
+                    # worker answering a push
+                    future = connection.pushes.get(request["push"]) if connection else None
+                    if future is not None and not future.done():
+                        future.set_result(request.get("result"))
+                    continue
+                if request["op"] == "hello":
+                    connection = WorkerConnection(request["cluster_id"], writer)
+                    self.workers[connection.cluster_id] = connection
+                asyncio.create_task(self.dispatch(connection, writer, request))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            self.connections.pop(asyncio.current_task(), None)
+            if connection is not None and self.workers.get(connection.cluster_id) is connection:
+                del self.workers[connection.cluster_id]
+            writer.close()
+
+    async def dispatch(self, connection: Optional[WorkerConnection], writer: asyncio.StreamWriter, request: dict) -> None:
+        try:
+            handler = getattr(self, "op_" + request["op"])
+            args = {k: v for k, v in request.items() if k not in ("id", "op")}
+            if request["op"] in ("hello", "claim"):
+                args["connection"] = connection
+            result = handler(**args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            reply = {"id": request.get("id"), "result": result}
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            reply = {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+        try:
+            await send_line(writer, reply)
+        except ConnectionError:
+            pass
+
+    def op_hello(self, connection: WorkerConnection, cluster_id: int, pid: int, shard_ids: List[int]) -> dict:
+        print(f"Cluster {cluster_id} connected (pid {pid}, shards {shard_ids})")
+        return {"limiter_ready": self.rate_limiter.ready}
+
+    def op_limiter_ready(self) -> bool:
+        return self.rate_limiter.ready
+
+    def op_warm(self, queues: List[dict], chats: List[dict]) -> bool:
+        if not self.rate_limiter.ready:
+            self.rate_limiter.warm(queues, chats)
+        return True
+
+    def op_begin_chat(self, user: str, now: int, limits: dict) -> Optional[str]:
+        """
+        Reason the chat is refused, or None after recording its queue entry and in-progress marker
+        """
+        started = self.in_progress.get(user)
+        if started is not None and now - started < IN_PROGRESS_TTL:
+            return "in_progress"
+        exceeded = self.rate_limiter.check(user, now, limits)
+        if exceeded is not None:
+            return exceeded
+        self.rate_limiter.add_queue(user, now)
+        self.in_progress[user] = now
+        return None
+
+    def op_end_chat(self, user: str, started: int, answered: bool) -> bool:
+        self.in_progress.pop(user, None)
+        if answered:
+            self.rate_limiter.add_chat(user, started)
+        return True
+
+    async def op_claim(self, connection: WorkerConnection, convo_id: str) -> bool:
+        """
+        Make the calling cluster the holder of `convo_id`. The previous holder flushes its turns
+        and drops its copy first; True tells the caller its own copy, if any, is stale.
+        """
+        now = int(time.time())
+        owner = self.owners.get(convo_id)
+        self.owners[convo_id] = [connection.cluster_id, now]
+        if owner is None:
+            return True
+        if owner[0] == connection.cluster_id:
+            return False
+        previous = self.workers.get(owner[0])
+        if previous is not None:
+            try:
+                await previous.push("release", self.claim_timeout, convo_id=convo_id)
+            except (asyncio.TimeoutError, ConnectionError):
+                print(f"Cluster {owner[0]} did not release conversation {convo_id} in time.")
+        return True
+
+    def op_health(self, cluster_id: int, report: dict) -> bool:
+        report["received"] = time.time()
+        self.health[cluster_id] = report
+        return True
+
+    def op_status(self) -> dict:
+        now = time.time()
+        status = {}
+        for cluster_id, report in sorted(self.health.items()):
+            status[str(cluster_id)] = dict(
+                report, connected=cluster_id in self.workers, age=round(now - report["received"], 1)
+            )
+        return status
+
+    def op_restart(self) -> bool:
+        if self.on_restart is None:
+            return False
+        return self.on_restart()
+
+
+class ClusterClient:
+    """
+    Worker side of the coordinator connection, one per process.
+    Connects lazily and again after the connection or its event loop went away.
+    Handlers registered with `on` answer the coordinator's pushes.
+    """
+    def __init__(self, path: str, cluster_id: int, shard_ids: List[int], shard_count: int, timeout: float = 10.0) -> None:
+        self.path = path
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.timeout = timeout
+        self.handlers: Dict[str, Callable[..., Awaitable]] = {}
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.read_task: Optional[asyncio.Task] = None
+        self.report_task: Optional[asyncio.Task] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        # guards connecting, per event loop: self.loop only changes once a connection is open
+        self.lock: Optional[asyncio.Lock] = None
+        self.lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["ClusterClient"]:
+        """
+        Client for a worker started by cluster.py, None when running standalone
+        """
+        path = os.environ.get("CHATBOT_CLUSTER_SOCKET")
+        if not path:
+            return None
+        return cls(
+            path=path,
+            cluster_id=int(os.environ["CHATBOT_CLUSTER_ID"]),
+            shard_ids=[int(i) for i in os.environ["CHATBOT_SHARD_IDS"].split(",")],
+            shard_count=int(os.environ["CHATBOT_SHARD_COUNT"]),
+        )
+
+    def bot_options(self) -> dict:
+        return {"shard_ids": self.shard_ids, "shard_count": self.shard_count}
+
+    def on(self, op: str, handler: Callable[..., Awaitable]) -> None:
+        self.handlers[op] = handler
+
+    def connected(self) -> bool:
+        return (
+            self.writer is not None and not self.writer.is_closing()
+            and self.loop is asyncio.get_running_loop()
+            and self.read_task is not None and not self.read_task.done()
+        )
+
+    async def connect(self) -> None:
+        """
+        Open the connection unless another task did while this one waited for the lock
+        """
+        loop = asyncio.get_running_loop()
+        if self.lock is None or self.lock_loop is not loop:
+            self.lock = asyncio.Lock()
+            self.lock_loop = loop
+        async with self.lock:
+            if self.connected():
+                return
+            if self.writer is not None and self.loop is loop:
+                self.writer.close()
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=2 ** 24)
+            self.loop = loop
+            self.pending = {}
+            self.read_task = asyncio.create_task(self.read_loop(self.reader, self.writer))
+            try:
+                await self.request("hello", cluster_id=self.cluster_id, pid=os.getpid(), shard_ids=self.shard_ids)
+            except BaseException:
+                self.read_task.cancel()
+                self.writer.close()
+                raise
+
+    async def read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "push" in message:
+                    asyncio.create_task(self.answer_push(writer, message))
+                    continue
+                future = self.pending.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(RuntimeError(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        except ConnectionError:
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("cluster coordinator connection lost"))
+            self.pending = {}
+            writer.close()
+
+    async def answer_push(self, writer: asyncio.StreamWriter, message: dict) -> None:
+        result = None
+        handler = self.handlers.get(message["op"])
+        try:
+            if handler is not None:
+                result = await handler(**{k: v for k, v in message.items() if k not in ("push", "op")})
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        try:
+            await send_line(writer, {"push": message["push"], "result": result})
+        except ConnectionError:
+            pass
+
+    async def request(self, op: str, **kwargs):
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        await send_line(self.writer, {"id": request_id, "op": op, **kwargs})
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def call(self, op: str, **kwargs):
+        # connect() checks again under its lock, concurrent first calls share one connection
+        if not self.connected():
+            await self.connect()
+        return await self.request(op, **kwargs)
+
+    async def begin_chat(self, user: str, now: int, limits: dict) -> Optional[str]:
+        return await self.call("begin_chat", user=user, now=now, limits={
+            'max_q_per_mn': limits['max_q_per_mn'],
+            'max_use_per_hour': limits['max_use_per_hour'],
+            'max_use_per_day': limits['max_use_per_day'],
+        })
+
+    async def end_chat(self, user: str, started: int, answered: bool) -> None:
+        await self.call("end_chat", user=user, started=started, answered=answered)
+
+    async def claim(self, convo_id: str) -> bool:
+        return await self.call("claim", convo_id=convo_id)
+
+    async def warm(self, queues: Iterable[dict], chats: Iterable[dict]) -> None:
+        await self.call("warm", queues=[
+            {'user_id': str(row['user_id']), 'started': row['started']} for row in queues
+        ], chats=[
+            {'user_id': str(row['user_id']), 'started': row['started']} for row in chats
+        ])
+
+    def start_reporting(self, collect: Callable[[], dict], interval: float = 15.0) -> None:
+        """
+        Send `collect()` as this cluster's health report every `interval` seconds
+        """
+        async def report():
+            while True:
+                try:
+                    await self.call("health", cluster_id=self.cluster_id, report=collect())
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                await asyncio.sleep(interval)
+        if self.report_task is None or self.report_task.done():
+            self.report_task = asyncio.create_task(report())
+
+    async def close(self) -> None:
+        if self.report_task is not None:
+            self.report_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def control(path: str, op: str, timeout: float = 10.0):
+    """
+    One-shot request to a running coordinator, for the status and restart commands
+    """
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        await send_line(writer, {"id": 1, "op": op})
+        reply = json.loads(await asyncio.wait_for(reader.readline(), timeout))
+    finally:
+        writer.close()
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
@@ -0,0 +1,151 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# every message follows <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_PER_MESSAGE = 4
+# every reply is primed with <im_start>assistant
+TOKENS_PER_REPLY = 2
+
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def count_message_tokens(encoding, message: dict) -> int:
+    """
+    Count tokens of a single chat message
+    """
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += 1  # role is always required and always 1 token
+    return num_tokens
+
+
+class Conversation:
+    """
+    Messages of one conversation with the token count of each message kept alongside,
+    so the total is maintained as messages come and go instead of re-encoding the history.
+    """
+    def __init__(self) -> None:
+        self.messages: List[dict] = []
+        self.tokens: List[int] = []
+        self.total: int = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, message: dict, tokens: int) -> None:
+        self.messages.append(message)
+        self.tokens.append(tokens)
+        self.total += tokens
+
+    def pop(self, index: int = -1) -> dict:
+        self.total -= self.tokens.pop(index)
+        return self.messages.pop(index)
+
+    def replace(self, start: int, end: int, message: dict, tokens: int) -> None:
+        """
+        Replace messages [start, end) with a single message
+        """
+        self.total += tokens - sum(self.tokens[start:end])
+        self.messages[start:end] = [message]
+        self.tokens[start:end] = [tokens]
+
+    def token_count(self) -> int:
+        """
+        Prompt size in tokens, including reply priming
+        """
+        return self.total + TOKENS_PER_REPLY
+
+
+class ConversationStore:
+    """
+    Conversations kept in memory, least recently used first. Entries idle for longer than
+    `idle_ttl` seconds, and the oldest entries once `max_entries` or `max_tokens` (sum of the
+    conversations' token totals) is exceeded, are evicted; callers reload them on a miss.
+    """
+    def __init__(self, max_entries: int = 10000, max_tokens: int = 5000000, idle_ttl: float = 3600.0) -> None:
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.idle_ttl = idle_ttl
+        self.entries: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.last_used: Dict[str, float] = {}
+        self.sizes: Dict[str, int] = {}
+        self.resident_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, convo_id: str) -> bool:
+        return convo_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, convo_id: str) -> Conversation:
+        conversation = self.entries[convo_id]
+        self.entries.move_to_end(convo_id)
+        self.last_used[convo_id] = time.monotonic()
+        return conversation
+
+    def __setitem__(self, convo_id: str, conversation: Conversation) -> None:
+        if convo_id in self.entries:
+            self.remove(convo_id)
+        self.entries[convo_id] = conversation
+        self.last_used[convo_id] = time.monotonic()
+        self.sizes[convo_id] = conversation.total
+        self.resident_tokens += conversation.total
+
+    def lookup(self, convo_id: str) -> Optional[Conversation]:
+        """
+        Get a conversation, counting the hit or miss
+        """
+        self.expire()
+        if convo_id in self.entries:
+            self.hits += 1
+            return self[convo_id]
+        self.misses += 1
+        return None
+
+    def remove(self, convo_id: str) -> None:
+        del self.entries[convo_id]
+        del self.last_used[convo_id]
+        self.resident_tokens -= self.sizes.pop(convo_id)
+
+    def update(self, convo_id: str) -> None:
+        """
+        Refresh the size of a conversation after it changed and evict others over budget
+        """
+        if convo_id not in self.entries:
+            return
+        total = self.entries[convo_id].total
+        self.resident_tokens += total - self.sizes[convo_id]
+        self.sizes[convo_id] = total
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_entries or self.resident_tokens > self.max_tokens
+        ):
+            oldest = next(iter(self.entries))
+            if oldest == convo_id:
+                break
+            self.remove(oldest)
+            self.evictions += 1
+
+    def expire(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        while self.entries:
+            oldest = next(iter(self.entries))
+            if self.last_used[oldest] > deadline:
+                break
+            self.remove(oldest)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "resident_tokens": self.resident_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
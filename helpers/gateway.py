@@ -0,0 +1,49 @@
+import discord
+
+
+def make_intents(config: dict) -> discord.Intents:
+    """
+    Gateway intents from the [discord] section. By default only what chat needs: guilds,
+    guild and DM messages and their content. Members and presences are opt-in since they make
+    Discord send (and the bot cache) every member and every presence change of every guild.
+    Any other intent can be added by name with intents_extra = ["voice_states", ...].
+    Without members the member cache only holds the bot and recent authors: permission checks
+    (Utils.is_moderator and co.) take the Member from the message or interaction, or fetch it.
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = config.get('intents_message_content', 1) == 1
+    intents.members = config.get('intents_members', 0) == 1
+    intents.presences = config.get('intents_presences', 0) == 1
+    for name in config.get('intents_extra', []):
+        setattr(intents, name, True)
+    return intents
+
+
+def make_member_cache(config: dict, intents: discord.Intents) -> discord.MemberCacheFlags:
+    """
+    member_cache = "none", "voice", "joined" or "intents" (as much as the intents allow, the default)
+    """
+    policy = config.get('member_cache', "intents")
+    if policy == "none":
+        return discord.MemberCacheFlags.none()
+    if policy == "voice":
+        return discord.MemberCacheFlags(voice=True, joined=False)
+    if policy == "joined":
+        return discord.MemberCacheFlags(voice=False, joined=True)
+    return discord.MemberCacheFlags.from_intents(intents)
+
+
+def bot_options(config: dict) -> dict:
+    """
+    Keyword arguments for the bot constructor: intents, member cache and guild chunking
+    """
+    intents = make_intents(config)
+    return {
+        "intents": intents,
+        "member_cache_flags": make_member_cache(config, intents),
+        # with the members intent, chunking downloads every member of every guild at startup
+        "chunk_guilds_at_startup": config.get('chunk_guilds', 0) == 1,
+    }
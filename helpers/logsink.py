@@ -0,0 +1,80 @@
+import asyncio
+import sys
+import traceback
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from helpers.chunker import split_message
+from helpers.metrics import counter
+
+LOG_LINES = counter("chatbot_log_lines_total", "Lines given to the channel log sink, sent or dropped")
+LOG_MESSAGES = counter("chatbot_log_messages_total", "Discord messages sent by the channel log sink")
+
+
+class ChannelLog:
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class LogSink:
+    """
+    Collects log lines per channel for `window` seconds after the first one and sends them
+    packed into as few messages of at most `limit` characters as possible. Past `max_pending`
+    lines waiting for a channel, new lines are dropped and counted, and the count is sent
+    with the next batch.
+    """
+    def __init__(
+        self, send: Callable[[int, str], Awaitable[None]], window: float = 2.0,
+        limit: int = 2000, max_pending: int = 200
+    ) -> None:
+        self.send = send
+        self.window = window
+        self.limit = limit
+        self.max_pending = max_pending
+        self.channels: Dict[int, ChannelLog] = {}
+        self.closing = asyncio.Event()
+
+    def put(self, channel_id: int, line: str) -> None:
+        log = self.channels.get(channel_id)
+        if log is None:
+            log = self.channels[channel_id] = ChannelLog()
+        if len(log.lines) >= self.max_pending:
+            log.dropped += 1
+            LOG_LINES.inc(result="dropped")
+            return
+        log.lines.append(line)
+        if log.task is None or log.task.done():
+            log.task = asyncio.create_task(self.run(channel_id, log))
+
+    async def run(self, channel_id: int, log: ChannelLog) -> None:
+        # lines arriving while a batch is being sent go out with the next window
+        while log.lines or log.dropped:
+            if not self.closing.is_set():
+                try:
+                    await asyncio.wait_for(self.closing.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush(channel_id, log)
+
+    async def flush(self, channel_id: int, log: ChannelLog) -> None:
+        lines, dropped = log.lines, log.dropped
+        log.lines, log.dropped = [], 0
+        LOG_LINES.inc(len(lines), result="sent")
+        if dropped:
+            lines.append(f"... {dropped} more log line(s) dropped")
+        for chunk in split_message("\n".join(lines), self.limit):
+            try:
+                await self.send(channel_id, chunk)
+                LOG_MESSAGES.inc()
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+    async def close(self) -> None:
+        """
+        Send everything pending without waiting for the window, used on unload/shutdown
+        """
+        self.closing.set()
+        tasks = [log.task for log in self.channels.values() if log.task is not None and not log.task.done()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,156 @@
+"""
+Minimal Prometheus text-format metrics, process-wide.
+
+Metrics are created through `counter`, `histogram` and `gauge`, which return the already
+registered metric of that name, so reloading a cog keeps its series instead of resetting them.
+"""
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: Dict[str, str], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{format_labels(dict(key))} {format_value(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [bucket counts..., sum, count]
+        self.values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterable[str]:
+        for key, series in self.values.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{format_labels(labels, ('le', format_value(float(bound))))} {count}"
+            yield f"{self.name}_bucket{format_labels(labels, ('le', '+Inf'))} {series[-1]}"
+            yield f"{self.name}_sum{format_labels(labels)} {format_value(series[-2])}"
+            yield f"{self.name}_count{format_labels(labels)} {series[-1]}"
+
+
+class Gauge:
+    """
+    Gauge read at scrape time from a callback returning (labels, value) pairs
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None
+
+    def samples(self) -> Iterable[str]:
+        if self.callback is None:
+            return
+        for labels, value in self.callback():
+            yield f"{self.name}{format_labels(labels)} {format_value(value)}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, object] = {}
+
+    def get_or_create(self, cls, name: str, documentation: str, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, **kwargs)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                lines.append(f"# {metric.name} failed: {type(e).__name__}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return registry.get_or_create(Counter, name, documentation)
+
+
+def histogram(name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.get_or_create(Histogram, name, documentation, buckets=buckets)
+
+
+def gauge(name: str, documentation: str, callback: Callable) -> Gauge:
+    """
+    Register (or re-point, e.g. after a cog reload) a callback gauge
+    """
+    metric = registry.get_or_create(Gauge, name, documentation)
+    metric.callback = callback
+    return metric
+
+
+def timed(metric: Histogram):
+    """
+    Decorator observing the duration of a coroutine method, labelled with its name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metric.time(method=func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
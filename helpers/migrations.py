@@ -0,0 +1,114 @@
+import sys
+import time
+import traceback
+from typing import List, Tuple
+
+# (version, description, steps). A step is an SQL statement, or a (table, index name, columns)
+# tuple for an index that is added only when missing, for tables which predate the migrations.
+MIGRATIONS: List[Tuple[int, str, list]] = [
+    (1, "chat tables", [
+        """
+        CREATE TABLE IF NOT EXISTS `chat_queues` (
+          `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          `user_id` VARCHAR(32) NOT NULL,
+          `user_server` VARCHAR(32) NOT NULL,
+          `guild_id` VARCHAR(32) NULL DEFAULT NULL,
+          `started` INT UNSIGNED NOT NULL,
+          `asked` TEXT NOT NULL,
+          PRIMARY KEY (`id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS `chat_messages` (
+          `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          `user_id` VARCHAR(32) NOT NULL,
+          `user_server` VARCHAR(32) NOT NULL,
+          `guild_id` VARCHAR(32) NULL DEFAULT NULL,
+          `data_id` VARCHAR(64) NULL DEFAULT NULL,
+          `convo_id` VARCHAR(64) NOT NULL,
+          `time` INT UNSIGNED NOT NULL,
+          `asked` TEXT NOT NULL,
+          `raw_response` MEDIUMTEXT NOT NULL,
+          `response` MEDIUMTEXT NOT NULL,
+          `started` INT UNSIGNED NOT NULL,
+          `finished` INT UNSIGNED NOT NULL,
+          PRIMARY KEY (`id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS `chat_conversation_turns` (
+          `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+          `convo_id` VARCHAR(64) NOT NULL,
+          `role` VARCHAR(16) NOT NULL,
+          `content` MEDIUMTEXT NOT NULL,
+          `tokens` INT UNSIGNED NOT NULL,
+          `created` INT UNSIGNED NOT NULL,
+          PRIMARY KEY (`id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+    ]),
+    (2, "covering indexes for rate limits and history", [
+        # rate limiter warm-up: range on started for one user_server, user_id read from the index
+        ("chat_queues", "server_started_user", "`user_server`, `started`, `user_id`"),
+        ("chat_messages", "server_started_user", "`user_server`, `started`, `user_id`"),
+        # history reload: latest turns of a conversation, newest first
+        ("chat_conversation_turns", "convo_id_id", "`convo_id`, `id`"),
+    ]),
+]
+LOCK_NAME = "chatbot_migrations"
+
+
+async def index_exists(cur, table: str, name: str) -> bool:
+    await cur.execute(
+        """
+        SELECT 1 FROM `information_schema`.`statistics`
+        WHERE `table_schema`=DATABASE() AND `table_name`=%s AND `index_name`=%s LIMIT 1
+        """, (table, name)
+    )
+    return await cur.fetchone() is not None
+
+
+async def migrate(conn, lock_timeout: int = 60) -> int:
+    """
+    Apply pending migrations in order on an autocommit connection, returns the schema version.
+    A named lock keeps concurrent processes (cluster workers) from running them twice.
+    """
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT GET_LOCK(%s, %s) AS `locked`", (LOCK_NAME, lock_timeout))
+        if not (await cur.fetchone())['locked']:
+            raise RuntimeError("timed out waiting for the migration lock")
+        try:
+            await cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS `schema_migrations` (
+                  `version` INT UNSIGNED NOT NULL,
+                  `description` VARCHAR(128) NOT NULL,
+                  `applied` INT UNSIGNED NOT NULL,
+                  PRIMARY KEY (`version`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+            await cur.execute("SELECT COALESCE(MAX(`version`), 0) AS `version` FROM `schema_migrations`")
+            version = (await cur.fetchone())['version']
+            for number, description, steps in MIGRATIONS:
+                if number <= version:
+                    continue
+                for step in steps:
+                    if isinstance(step, tuple):
+                        table, name, columns = step
+                        if await index_exists(cur, table, name):
+                            continue
+                        step = f"ALTER TABLE `{table}` ADD INDEX `{name}` ({columns})"
+                    await cur.execute(step)
+                await cur.execute(
+                    "INSERT INTO `schema_migrations` (`version`, `description`, `applied`) VALUES (%s, %s, %s)",
+                    (number, description, int(time.time()))
+                )
+                version = number
+                print(f"Applied migration {number}: {description}")
+            return version
+        finally:
+            try:
+                await cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
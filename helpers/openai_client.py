@@ -0,0 +1,105 @@
+import json
+from typing import AsyncIterable, AsyncIterator, Optional
+
+import aiohttp
+
+from helpers.sse import SSEParser
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+async def read_events(chunks: AsyncIterable[bytes], raw: Optional[bytearray] = None) -> AsyncIterator[dict]:
+    """
+    Decode server-sent events from byte chunks as they arrive, until [DONE].
+    The raw payload is appended to `raw` when given.
+    """
+    parser = SSEParser(raw)
+    async for chunk in chunks:
+        for data in parser.feed(chunk):
+            if data == b"[DONE]":
+                return
+            yield json.loads(data)
+    for data in parser.close():
+        if data == b"[DONE]":
+            return
+        yield json.loads(data)
+
+
+class UpstreamError(Exception):
+    """
+    Raised when the upstream answers with a non-200 status
+    """
+    def __init__(self, status: int, body: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(f"upstream returned status {status}")
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+
+class OpenAIClient:
+    """
+    Streaming chat completion client on a pooled aiohttp connector.
+    One instance is shared by every chat so connections are kept alive and reused
+    instead of pinning a thread per in-flight stream.
+    """
+    def __init__(
+        self, api_key: str, url: str = OPENAI_CHAT_URL, connection_limit: int = 100,
+        connection_limit_per_host: int = 0, keepalive_timeout: float = 30.0
+    ) -> None:
+        self.api_key = api_key
+        self.url = url
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "OpenAIClient":
+        openai = config['openai']
+        return cls(
+            api_key=openai['key'],
+            url=openai.get('url', OPENAI_CHAT_URL),
+            connection_limit=openai.get('connection_limit', 100),
+            connection_limit_per_host=openai.get('connection_limit_per_host', 0),
+            keepalive_timeout=openai.get('keepalive_timeout', 30.0),
+        )
+
+    async def open(self) -> None:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def stream_chat(
+        self, json_data: dict, raw: Optional[bytearray] = None, url: Optional[str] = None,
+        api_key: Optional[str] = None, connect_timeout: Optional[float] = None
+    ) -> AsyncIterator[dict]:
+        """
+        Post a streaming chat completion and yield decoded chunks as they arrive,
+        the raw payload is appended to `raw` when given. `url` and `api_key` override
+        the client's own for one request, see helpers/upstream.py. Only connecting is
+        timed out here, the caller bounds the wait for chunks.
+        """
+        await self.open()
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer {}".format(api_key or self.api_key),
+        }
+        timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout)
+        async with self.session.post(url or self.url, headers=headers, json=json_data, timeout=timeout) as response:
+            if response.status != 200:
+                retry_after = response.headers.get("Retry-After")
+                raise UpstreamError(
+                    response.status, await response.text(),
+                    float(retry_after) if retry_after and retry_after.replace(".", "", 1).isdigit() else None
+                )
+            async for resp in read_events(response.content.iter_any(), raw):
+                yield resp
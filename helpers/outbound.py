@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import time
+from typing import Deque, Dict, List, Optional
+
+import discord
+
+from helpers.metrics import histogram
+
+DISCORD_LATENCY = histogram("chatbot_discord_seconds", "Discord API call latency by operation")
+
+
+def merge_chunks(chunks: List[str], limit: int) -> List[str]:
+    """
+    Join adjacent chunks with a newline while the result fits in `limit` characters.
+    Chunks from split_message have their code blocks closed, so joining them keeps markdown intact.
+    """
+    merged: List[str] = []
+    for chunk in chunks:
+        if not chunk.strip():
+            continue
+        if merged and len(merged[-1]) + 1 + len(chunk) <= limit:
+            merged[-1] = merged[-1] + "\n" + chunk
+        else:
+            merged.append(chunk)
+    return merged
+
+
+class OutboundJob:
+    def __init__(self, chunks: List[str], merge: bool, reference: Optional[discord.Message] = None) -> None:
+        self.chunks = chunks
+        self.merge = merge
+        # the first chunk is sent as a reply to it
+        self.reference = reference
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class ChannelQueue:
+    def __init__(self, channel, burst: int) -> None:
+        self.channel = channel
+        self.jobs: Deque[OutboundJob] = collections.deque()
+        self.task: Optional[asyncio.Task] = None
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # set from a 429's Retry-After
+        self.blocked_until = 0.0
+        # paced calls in flight, the queue is kept while there are any
+        self.editing = 0
+
+
+class OutboundDispatcher:
+    """
+    One queue per channel for outgoing messages. The chunks of one reply are sent in order
+    and never interleaved with another reply to the same channel. Sends are paced with a token
+    bucket per channel sized to Discord's message limit (`rate` messages per `per` seconds) so
+    bursts wait here instead of hitting 429s, and a 429 that still happens blocks the channel
+    for its Retry-After before the chunk is retried. Short notices queued with merge=True
+    are packed together with the notices queued right behind them. Edits of messages already
+    sent take a token from the same bucket, so every call to a channel is paced together.
+    Shared by every cog of the process.
+    """
+    def __init__(self, rate: int = 5, per: float = 5.0, limit: int = 2000, retries: int = 3) -> None:
+        self.rate = rate
+        self.per = per
+        self.limit = limit
+        self.retries = retries
+        self.queues: Dict[int, ChannelQueue] = {}
+
+    def configure(self, rate: int = 5, per: float = 5.0, limit: int = 2000) -> None:
+        self.rate = rate
+        self.per = per
+        self.limit = limit
+
+    def depth(self) -> Dict[int, int]:
+        """
+        Chunks waiting per channel, channels with an empty queue are left out
+        """
+        return {
+            channel_id: sum(len(job.chunks) for job in queue.jobs)
+            for channel_id, queue in self.queues.items() if queue.jobs
+        }
+
+    def queue(self, channel) -> ChannelQueue:
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = ChannelQueue(channel, self.rate)
+        return queue
+
+    def discard(self, queue: ChannelQueue) -> None:
+        idle = not queue.jobs and not queue.editing and (queue.task is None or queue.task.done())
+        if idle and self.queues.get(queue.channel.id) is queue:
+            del self.queues[queue.channel.id]
+
+    async def send(
+        self, channel, chunks: List[str], merge: bool = False, reference: Optional[discord.Message] = None
+    ) -> List[discord.Message]:
+        """
+        Queue the chunks of one reply and wait until they are sent, returns the messages.
+        With `reference` the first chunk replies to that message (not merged with other notices).
+        Raises the error of the first chunk that could not be sent, the rest are not sent.
+        """
+        chunks = merge_chunks(chunks, self.limit)
+        if not chunks:
+            return []
+        queue = self.queue(channel)
+        job = OutboundJob(chunks, merge and reference is None, reference)
+        queue.jobs.append(job)
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.create_task(self.run(queue))
+        # the job stays queued if the caller is cancelled
+        return await asyncio.shield(job.future)
+
+    async def run(self, queue: ChannelQueue) -> None:
+        while queue.jobs:
+            batch = [queue.jobs.popleft()]
+            if batch[0].merge:
+                while queue.jobs and queue.jobs[0].merge:
+                    batch.append(queue.jobs.popleft())
+            chunks = merge_chunks([chunk for job in batch for chunk in job.chunks], self.limit)
+            try:
+                messages = [
+                    await self.deliver(queue, chunk, batch[0].reference if i == 0 else None)
+                    for i, chunk in enumerate(chunks)
+                ]
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_result(messages)
+        queue.task = None
+        self.discard(queue)
+
+    async def acquire(self, queue: ChannelQueue) -> None:
+        while True:
+            now = time.monotonic()
+            queue.tokens = min(self.rate, queue.tokens + (now - queue.updated) * self.rate / self.per)
+            queue.updated = now
+            wait = queue.blocked_until - now
+            if wait <= 0:
+                if queue.tokens >= 1:
+                    queue.tokens -= 1
+                    return
+                wait = (1 - queue.tokens) * self.per / self.rate
+            await asyncio.sleep(wait)
+
+    async def call(self, queue: ChannelQueue, op: str, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire(queue)
+            try:
+                with DISCORD_LATENCY.time(op=op):
+                    return await func(*args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt >= self.retries:
+                    raise
+                attempt += 1
+                retry_after = float(e.response.headers.get("Retry-After", 1.0))
+                queue.blocked_until = time.monotonic() + retry_after
+                queue.tokens = 0.0
+
+    async def deliver(
+        self, queue: ChannelQueue, content: str, reference: Optional[discord.Message] = None
+    ) -> discord.Message:
+        if reference is not None:
+            return await self.call(queue, "reply", queue.channel.send, content, reference=reference)
+        return await self.call(queue, "send", queue.channel.send, content)
+
+    async def paced(self, channel, op: str, func, *args, **kwargs):
+        """
+        Make a call outside the queue (edits, replies to a command context) that still takes
+        a token from the channel's bucket
+        """
+        queue = self.queue(channel)
+        queue.editing += 1
+        try:
+            return await self.call(queue, op, func, *args, **kwargs)
+        finally:
+            queue.editing -= 1
+            self.discard(queue)
+
+    async def edit(self, message: discord.Message, content: str) -> discord.Message:
+        """
+        Edit a message sent earlier, paced with the sends of its channel
+        """
+        return await self.paced(message.channel, "edit", message.edit, content=content)
+
+    async def close(self) -> None:
+        """
+        Wait until every queued message is sent
+        """
+        tasks = [queue.task for queue in self.queues.values() if queue.task is not None and not queue.task.done()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+outbound = OutboundDispatcher()
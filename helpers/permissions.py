@@ -0,0 +1,66 @@
+from typing import Dict, Optional, Tuple
+
+import discord
+
+MANAGE_CHANNELS = discord.Permissions(manage_channels=True).value
+MANAGE_MESSAGES = discord.Permissions(manage_messages=True).value
+BAN_MEMBERS = discord.Permissions(ban_members=True).value
+MODERATE_MEMBERS = discord.Permissions(moderate_members=True).value
+
+
+def role_key(member: discord.Member) -> Tuple[int, ...]:
+    # a change of roles invalidates the member's entry
+    return tuple(role.id for role in member.roles)
+
+
+class GuildSnapshot:
+    def __init__(self) -> None:
+        # member id -> (roles, guild-level permission bits)
+        self.members: Dict[int, Tuple[Tuple[int, ...], int]] = {}
+
+
+class PermissionCache:
+    """
+    Permission snapshots per guild kept as the integer bitfield of discord.Permissions,
+    computed on first check and dropped by the role and guild events that can change
+    them (wired in the Utils cog). Entries are also keyed by the member's role ids, so a member
+    whose roles changed is recomputed even without the members intent (no member events then).
+    Shared by every Utils instance of the process.
+    """
+    def __init__(self, max_entries_per_guild: int = 10000) -> None:
+        self.max_entries_per_guild = max_entries_per_guild
+        self.guilds: Dict[int, GuildSnapshot] = {}
+
+    def snapshot(self, guild_id: int) -> GuildSnapshot:
+        snapshot = self.guilds.get(guild_id)
+        if snapshot is None:
+            snapshot = self.guilds[guild_id] = GuildSnapshot()
+        return snapshot
+
+    def value(self, member: discord.Member) -> int:
+        snapshot = self.snapshot(member.guild.id)
+        roles = role_key(member)
+        entry = snapshot.members.get(member.id)
+        if entry is None or entry[0] != roles:
+            if len(snapshot.members) >= self.max_entries_per_guild:
+                snapshot.members.clear()
+            entry = snapshot.members[member.id] = (roles, member.guild_permissions.value)
+        return entry[1]
+
+    def has_any(self, member: Optional[discord.Member], flags: int) -> bool:
+        return member is not None and self.value(member) & flags != 0
+
+    def has_all(self, member: Optional[discord.Member], flags: int) -> bool:
+        return member is not None and self.value(member) & flags == flags
+
+    def invalidate_member(self, guild_id: int, member_id: int) -> None:
+        snapshot = self.guilds.get(guild_id)
+        if snapshot is None:
+            return
+        snapshot.members.pop(member_id, None)
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        self.guilds.pop(guild_id, None)
+
+
+permissions = PermissionCache()
@@ -0,0 +1,97 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+
+class WindowCounter:
+    """
+    Per-key event counts over a sliding window, kept as a deque of [bucket, count] pairs
+    `granularity` seconds wide plus a running total. Old buckets are dropped from the left
+    as the window moves, so add and count are amortized O(1). An event is counted while its
+    bucket is still inside the window, i.e. up to `granularity` seconds past `window`.
+    """
+    def __init__(self, window: int, granularity: int) -> None:
+        self.window = window
+        self.granularity = granularity
+        self.buckets: Dict[str, Deque[List[int]]] = {}
+        self.totals: Dict[str, int] = {}
+
+    def expire(self, key: str, now: int) -> None:
+        buckets = self.buckets.get(key)
+        if not buckets:
+            return
+        oldest = (now - self.window) // self.granularity
+        while buckets and buckets[0][0] < oldest:
+            self.totals[key] -= buckets.popleft()[1]
+
+    def add(self, key: str, timestamp: int, n: int = 1) -> None:
+        bucket = timestamp // self.granularity
+        buckets = self.buckets.setdefault(key, deque())
+        if buckets and buckets[-1][0] >= bucket:
+            # same bucket, or a late event which is kept in the newest bucket
+            buckets[-1][1] += n
+        else:
+            buckets.append([bucket, n])
+        self.totals[key] = self.totals.get(key, 0) + n
+
+    def count(self, key: str, now: int) -> int:
+        self.expire(key, now)
+        return self.totals.get(key, 0)
+
+    def prune(self, now: int) -> None:
+        """
+        Forget keys with nothing left in the window
+        """
+        for key in list(self.buckets):
+            self.expire(key, now)
+            if not self.buckets[key]:
+                del self.buckets[key]
+                del self.totals[key]
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class ChatRateLimiter:
+    """
+    In-memory replacement of the per-message COUNT(*) over chat_queues (last minute)
+    and chat_messages (last hour, last day).
+    """
+    def __init__(self) -> None:
+        self.queues = WindowCounter(60, 1)
+        self.chats_hour = WindowCounter(3600, 60)
+        self.chats_day = WindowCounter(24 * 3600, 600)
+        self.ready = False
+
+    def add_queue(self, key: str, timestamp: int) -> None:
+        self.queues.add(key, timestamp)
+
+    def add_chat(self, key: str, timestamp: int) -> None:
+        self.chats_hour.add(key, timestamp)
+        self.chats_day.add(key, timestamp)
+
+    def check(self, key: str, now: int, config: dict) -> Optional[str]:
+        """
+        Name of the first exceeded limit ("minute", "day" or "hour"), None when allowed
+        """
+        if self.queues.count(key, now) >= config['max_q_per_mn']:
+            return "minute"
+        if self.chats_day.count(key, now) >= config['max_use_per_day']:
+            return "day"
+        if self.chats_hour.count(key, now) >= config['max_use_per_hour']:
+            return "hour"
+        return None
+
+    def warm(self, queues: Iterable[dict], chats: Iterable[dict]) -> None:
+        """
+        Load rows of {'user_id', 'started'} read from chat_queues and chat_messages
+        """
+        for row in queues:
+            self.add_queue(str(row['user_id']), row['started'])
+        for row in chats:
+            self.add_chat(str(row['user_id']), row['started'])
+        self.ready = True
+
+    def prune(self, now: int) -> None:
+        self.queues.prune(now)
+        self.chats_hour.prune(now)
+        self.chats_day.prune(now)
@@ -0,0 +1,42 @@
+import re
+from typing import Optional
+
+from cachetools import TTLCache
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class ResponseCache:
+    """
+    Answers to one-shot questions asked on a brand-new conversation, keyed on everything
+    the upstream sees for such a request: engine, temperature, system prompt and the prompt.
+    """
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600.0) -> None:
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(engine: str, temperature: float, system_prompt: str, prompt: str) -> tuple:
+        normalized = WHITESPACE.sub(" ", prompt).strip().lower()
+        return engine, temperature, system_prompt, normalized
+
+    def get(self, key: tuple) -> Optional[dict]:
+        response = self.cache.get(key)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, key: tuple, response: dict) -> None:
+        self.cache[key] = response
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
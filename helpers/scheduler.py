@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+
+class QueueFull(Exception):
+    """
+    Raised when no more requests may wait for an upstream slot
+    """
+    pass
+
+
+class Ticket:
+    def __init__(self, guild_id: str, position: int, future: asyncio.Future) -> None:
+        self.guild_id = guild_id
+        self.position = position
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class FairScheduler:
+    """
+    Caps concurrent upstream requests globally and hands free slots to waiting guilds
+    in weighted round-robin: a guild with weight w is served up to w requests per turn,
+    so a busy guild cannot starve the others. Per-user fairness comes from each user
+    having a single request in flight.
+    """
+    def __init__(
+        self, max_concurrent: int = 16, max_queued: int = 500, max_queued_per_guild: int = 50,
+        weights: Optional[Dict[str, int]] = None
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_guild = max_queued_per_guild
+        self.weights = {str(k): v for k, v in (weights or {}).items()}
+        self.active = 0
+        self.waiting = 0
+        self.queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.served: Dict[str, int] = {}
+        # metrics
+        self.granted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def estimate_position(self, guild_id: str) -> int:
+        """
+        Requests served before a new one from `guild_id`, assuming equal weights
+        """
+        own = len(self.queues.get(guild_id, ()))
+        return own + 1 + sum(min(len(q), own + 1) for g, q in self.queues.items() if g != guild_id)
+
+    def enqueue(self, guild_id: str) -> Ticket:
+        """
+        Take a slot right away (position 0) or join the guild's queue. Raises QueueFull
+        """
+        guild_id = str(guild_id)
+        future = asyncio.get_running_loop().create_future()
+        if self.active < self.max_concurrent and not self.waiting:
+            self.active += 1
+            self.granted += 1
+            future.set_result(None)
+            return Ticket(guild_id, 0, future)
+        queue = self.queues.get(guild_id)
+        if self.waiting >= self.max_queued or (queue and len(queue) >= self.max_queued_per_guild):
+            self.rejected += 1
+            raise QueueFull(f"{self.waiting} requests queued")
+        ticket = Ticket(guild_id, self.estimate_position(guild_id), future)
+        self.queues.setdefault(guild_id, deque()).append(ticket)
+        self.served.setdefault(guild_id, 0)
+        self.waiting += 1
+        return ticket
+
+    async def wait(self, ticket: Ticket) -> float:
+        """
+        Wait for the ticket's slot, returns the time waited. Release the slot when done.
+        """
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.cancelled():
+                self.discard(ticket)
+            else:
+                # granted while being cancelled
+                self.release()
+            raise
+        waited = time.monotonic() - ticket.enqueued
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def discard(self, ticket: Ticket) -> None:
+        queue = self.queues.get(ticket.guild_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[ticket.guild_id]
+                del self.served[ticket.guild_id]
+
+    def release(self) -> None:
+        self.active -= 1
+        self.grant()
+
+    def grant(self) -> None:
+        while self.active < self.max_concurrent and self.queues:
+            guild_id, queue = next(iter(self.queues.items()))
+            ticket = queue.popleft()
+            self.waiting -= 1
+            self.served[guild_id] += 1
+            if not queue:
+                del self.queues[guild_id]
+                del self.served[guild_id]
+            elif self.served[guild_id] >= self.weights.get(guild_id, 1):
+                self.served[guild_id] = 0
+                self.queues.move_to_end(guild_id)
+            if ticket.future.done():
+                continue
+            self.active += 1
+            self.granted += 1
+            ticket.future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "guilds_waiting": len(self.queues),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.granted if self.granted else 0.0,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,72 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class Flight:
+    """
+    One upstream request shared by every caller waiting on it
+    """
+    def __init__(self) -> None:
+        self.parts: List[str] = []
+        self.listeners: List[Callable[[str], None]] = []
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def broadcast(self, delta: str) -> None:
+        self.parts.append(delta)
+        for listener in list(self.listeners):
+            listener(delta)
+
+
+class SingleFlight:
+    """
+    Runs each request in its own task so identical requests started while one is in flight
+    share it: every waiter gets the deltas already received, then the following ones, and the
+    same result. A waiter going away only unsubscribes; the upstream request is cancelled
+    once nobody waits for it anymore.
+    """
+    def __init__(self) -> None:
+        self.flights: Dict[Hashable, Flight] = {}
+        self.coalesced = 0
+
+    def get(self, key: Optional[Hashable]) -> Optional[Flight]:
+        if key is None:
+            return None
+        return self.flights.get(key)
+
+    def start(self, key: Optional[Hashable], fn: Callable[[Callable[[str], None]], Awaitable]) -> Flight:
+        """
+        Start `fn(on_delta)` as a new flight, joinable under `key` unless it is None
+        """
+        flight = Flight()
+        if key is not None:
+            self.flights[key] = flight
+        flight.task = asyncio.create_task(self.run(key, flight, fn))
+        return flight
+
+    async def run(self, key: Optional[Hashable], flight: Flight, fn) -> object:
+        try:
+            return await fn(flight.broadcast)
+        finally:
+            if key is not None and self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def wait(self, flight: Flight, on_delta: Optional[Callable[[str], None]] = None) -> object:
+        if flight.waiters > 0:
+            self.coalesced += 1
+        flight.waiters += 1
+        if on_delta is not None:
+            for delta in flight.parts:
+                on_delta(delta)
+            flight.listeners.append(on_delta)
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # last one waiting, stop the upstream request
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if on_delta is not None:
+                flight.listeners.remove(on_delta)
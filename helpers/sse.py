@@ -0,0 +1,81 @@
+import re
+from typing import List, Optional
+
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+class SSEParser:
+    """
+    Incremental server-sent events parser fed raw byte chunks as they arrive.
+    Chunks may end anywhere, inside a line or between the \\r and \\n of a line break.
+    An event's `data:` lines are joined with \\n, comments and other fields are skipped.
+    Every chunk fed is also appended to `raw` when given, so the payload is kept once for logging.
+    """
+    def __init__(self, raw: Optional[bytearray] = None) -> None:
+        self.buffer = bytearray()
+        self.data: List[bytes] = []
+        self.raw = raw
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        Consume a chunk, returns the data of every event it completed
+        """
+        if self.raw is not None:
+            self.raw += chunk
+        self.buffer += chunk
+        return self.parse(final=False)
+
+    def close(self) -> List[bytes]:
+        """
+        End of stream: flush a trailing unterminated line and a pending event
+        """
+        events = self.parse(final=True)
+        if self.buffer:
+            self.line(bytes(self.buffer), events)
+            self.buffer.clear()
+        if self.data:
+            events.append(b"\n".join(self.data))
+            self.data = []
+        return events
+
+    def parse(self, final: bool) -> List[bytes]:
+        events = []
+        buffer = self.buffer
+        pos = 0
+        end = len(buffer)
+        if b"\r" not in buffer:
+            # common case, plain \n line breaks
+            while True:
+                index = buffer.find(b"\n", pos)
+                if index < 0:
+                    break
+                self.line(bytes(buffer[pos:index]), events)
+                pos = index + 1
+            end = pos
+        while pos < end:
+            match = LINE_END.search(buffer, pos)
+            if match is None:
+                break
+            if match.group() == b"\r" and match.end() == end and not final:
+                # may be the first half of \r\n, wait for the next chunk
+                break
+            self.line(bytes(buffer[pos:match.start()]), events)
+            pos = match.end()
+        if pos:
+            del buffer[:pos]
+        return events
+
+    def line(self, line: bytes, events: List[bytes]) -> None:
+        if not line:
+            if self.data:
+                events.append(b"\n".join(self.data))
+                self.data = []
+            return
+        if line.startswith(b":"):
+            return
+        field, _, value = line.partition(b":")
+        if field != b"data":
+            return
+        if value.startswith(b" "):
+            value = value[1:]
+        self.data.append(value)
@@ -0,0 +1,98 @@
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from discord import app_commands
+
+
+class StartupTimings:
+    """
+    Wall time of each startup stage, in the order the stages began. Stages may nest
+    (the tokenizer and DB pool are loaded while the cogs load).
+    """
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.begun: Dict[str, float] = {}
+        self.stages: Dict[str, float] = {}
+        self.reported = False
+
+    def begin(self, name: str) -> None:
+        self.begun[name] = time.perf_counter()
+        self.stages.setdefault(name, 0.0)
+
+    def end(self, name: str) -> None:
+        begun = self.begun.pop(name, None)
+        if begun is not None:
+            self.stages[name] += time.perf_counter() - begun
+
+    def record(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> str:
+        return "Startup in {:.2f}s: {}".format(
+            self.total(), ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        )
+
+
+startup = StartupTimings()
+
+
+def command_payload(command, tree: app_commands.CommandTree) -> dict:
+    # to_dict() takes the tree since discord.py 2.4, the pinned 2.2.2 takes no argument
+    if len(inspect.signature(command.to_dict).parameters) > 0:
+        return command.to_dict(tree)
+    return command.to_dict()
+
+
+def tree_hash(tree: app_commands.CommandTree) -> str:
+    """
+    Hash of the global application commands as they would be sent to Discord by tree.sync()
+    """
+    payload = sorted(
+        (command_payload(command, tree) for command in tree.get_commands()),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def load_synced_hash(path: str, application_id: int) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return json.load(f).get(str(application_id))
+    except FileNotFoundError:
+        return None
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        return None
+
+
+def save_synced_hash(path: str, application_id: int, digest: str) -> None:
+    try:
+        hashes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                hashes = json.load(f)
+        hashes[str(application_id)] = digest
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(hashes, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
@@ -0,0 +1,101 @@
+import asyncio
+import sys
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from helpers.chunker import split_message
+from helpers.outbound import outbound
+
+
+class EditPacer:
+    """
+    Spaces message edits per channel so every streaming reply in a channel shares
+    one edit budget instead of each reply editing at its own pace.
+    """
+    def __init__(self, interval: float = 1.0) -> None:
+        self.interval = interval
+        self.next_slot: Dict[int, float] = {}
+
+    async def wait(self, channel_id: int) -> None:
+        now = time.monotonic()
+        slot = max(now, self.next_slot.get(channel_id, 0.0))
+        self.next_slot[channel_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        elif len(self.next_slot) > 10000:
+            # drop channels whose slot already passed
+            self.next_slot = {k: v for k, v in self.next_slot.items() if v > now}
+
+
+class StreamingReply:
+    """
+    Shows an answer while it is being generated: deltas are buffered by `feed` and a background
+    task edits the reply at the pace allowed by the channel's EditPacer. Text beyond `char_limit`
+    rolls over into follow-up messages.
+    """
+    def __init__(self, channel, header: str, char_limit: int, pacer: EditPacer, message=None) -> None:
+        self.channel = channel
+        self.header = header
+        self.char_limit = char_limit
+        self.pacer = pacer
+        self.messages: List = [message] if message is not None else []
+        self.sent: List[Optional[str]] = [None] * len(self.messages)
+        self.parts: List[str] = []
+        self.dirty = asyncio.Event()
+        self.done = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def feed(self, delta: str) -> None:
+        if delta:
+            self.parts.append(delta)
+            self.dirty.set()
+
+    def split(self) -> List[str]:
+        return split_message(self.header + "".join(self.parts), self.char_limit)
+
+    async def flush(self) -> None:
+        self.dirty.clear()
+        for i, chunk in enumerate(self.split()):
+            if i < len(self.messages):
+                if self.sent[i] == chunk:
+                    continue
+                await self.pacer.wait(self.channel.id)
+                await outbound.edit(self.messages[i], chunk)
+                self.sent[i] = chunk
+            else:
+                self.messages.extend(await outbound.send(self.channel, [chunk]))
+                self.sent.append(chunk)
+
+    async def run(self) -> None:
+        while True:
+            await self.dirty.wait()
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            # text fed while that flush was in flight still has to be written
+            if self.done and not self.dirty.is_set():
+                break
+
+    def cancel(self) -> None:
+        """
+        Stop the background editor, leaving the messages as they are
+        """
+        self.done = True
+        if self.task is not None:
+            self.task.cancel()
+
+    async def finish(self) -> None:
+        """
+        Write the final text and stop the background editor
+        """
+        self.done = True
+        if self.task is None:
+            await self.flush()
+            return
+        self.dirty.set()
+        await self.task
@@ -0,0 +1,68 @@
+from typing import List, Optional, Tuple
+
+from helpers.conversation import Conversation
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_ROLE = "summary"
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below for your own later reference, in at most {words} words. "
+    "Keep facts, names, numbers, decisions, open questions and code identifiers the user may refer back to. "
+    "Write plain sentences, no preamble."
+)
+
+
+def is_summary(message: dict) -> bool:
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+
+def summary_message(text: str) -> dict:
+    return {"role": "system", "content": SUMMARY_PREFIX + text.strip()}
+
+
+def first_turn(conversation: Conversation) -> int:
+    """
+    Index of the oldest turn that is neither the system prompt nor the summary
+    """
+    if len(conversation) > 1 and is_summary(conversation.messages[1]):
+        return 2
+    return 1
+
+
+def choose_span(conversation: Conversation, low_water: int, summary_tokens: int) -> Optional[Tuple[int, int]]:
+    """
+    Oldest turns [first, end) to fold into the summary so the prompt drops to `low_water`
+    tokens with room for a summary of `summary_tokens`. Compaction starts at the target and
+    goes down to the lower mark, so the next few replies fit without folding again.
+    The kept turns start at a user message and the latest exchange is always kept.
+    None when there is nothing to compact.
+    """
+    first = first_turn(conversation)
+    remaining = conversation.token_count() - sum(conversation.tokens[1:first]) + summary_tokens
+    end = first
+    while end < len(conversation) - 1 and remaining > low_water:
+        remaining -= conversation.tokens[end]
+        end += 1
+    # never leave a reply without the message it answers
+    messages = conversation.messages
+    while end < len(conversation) and messages[end]["role"] != "user":
+        end += 1
+    if end == len(conversation):
+        end = max((i for i in range(first, len(conversation)) if messages[i]["role"] == "user"), default=first)
+    if end == first:
+        return None
+    return first, end
+
+
+def build_request(previous: Optional[dict], turns: List[dict], summary_tokens: int) -> List[dict]:
+    """
+    Messages asking for a summary of `turns`, folding in the previous summary if any
+    """
+    lines = []
+    if previous is not None:
+        lines.append("Earlier summary: " + previous["content"][len(SUMMARY_PREFIX):])
+    for message in turns:
+        lines.append("{}: {}".format(message["role"], message["content"]))
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=int(summary_tokens * 0.7))},
+        {"role": "user", "content": "\n\n".join(lines)},
+    ]
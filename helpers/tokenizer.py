@@ -0,0 +1,79 @@
+"""
+Process-wide tiktoken encoders, resolved once per engine.
+
+BPE ranks are read through tiktoken's own file cache. Point `tiktoken_cache_dir` at a directory
+populated beforehand and the bot starts with no network access:
+
+    python -m helpers.tokenizer data/tiktoken cl100k_base
+
+A TIKTOKEN_CACHE_DIR already set in the environment wins over the configured directory.
+"""
+import os
+import sys
+from typing import Dict, Optional
+
+import tiktoken
+
+DEFAULT_ENGINE_ENCODINGS: Dict[str, str] = {
+    "gpt-3.5-turbo": "cl100k_base",
+    "gpt-3.5-turbo-": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-4-": "cl100k_base",
+}
+
+
+class TokenizerRegistry:
+    """
+    Maps engines to encoding names and keeps the loaded encoders.
+    Engine names match exactly first, then by the longest configured prefix.
+    """
+    def __init__(self) -> None:
+        self.engine_encodings: Dict[str, str] = dict(DEFAULT_ENGINE_ENCODINGS)
+        self.cache_dir: Optional[str] = None
+        self.encoders: Dict[str, tiktoken.Encoding] = {}
+
+    def configure(self, engine_encodings: Optional[Dict[str, str]] = None, cache_dir: Optional[str] = None) -> None:
+        mapping = dict(DEFAULT_ENGINE_ENCODINGS)
+        mapping.update(engine_encodings or {})
+        self.engine_encodings = mapping
+        self.cache_dir = cache_dir
+
+    def apply_cache_dir(self) -> Optional[str]:
+        """
+        Point tiktoken at the configured cache directory unless TIKTOKEN_CACHE_DIR is set,
+        called once at startup before the first encoder loads. Returns the directory in use.
+        """
+        if self.cache_dir:
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", self.cache_dir)
+        return os.environ.get("TIKTOKEN_CACHE_DIR")
+
+    def encoding_name(self, engine: str) -> str:
+        if engine in self.engine_encodings:
+            return self.engine_encodings[engine]
+        prefixes = [p for p in self.engine_encodings if p.endswith("-") and engine.startswith(p)]
+        if not prefixes:
+            raise NotImplementedError(f"Unsupported engine {engine}")
+        return self.engine_encodings[max(prefixes, key=len)]
+
+    def get(self, engine: str) -> tiktoken.Encoding:
+        """
+        Encoder of the engine, loading its BPE ranks on first use
+        """
+        name = self.encoding_name(engine)
+        encoder = self.encoders.get(name)
+        if encoder is None:
+            encoder = tiktoken.get_encoding(name)
+            self.encoders[name] = encoder
+        return encoder
+
+
+tokenizers = TokenizerRegistry()
+
+
+if __name__ == "__main__":
+    # prefetch: python -m helpers.tokenizer <cache_dir> <encoding> [<encoding> ...]
+    tokenizers.configure(cache_dir=sys.argv[1])
+    cache_dir = tokenizers.apply_cache_dir()
+    for encoding_name in sys.argv[2:]:
+        tiktoken.get_encoding(encoding_name)
+        print(f"Cached {encoding_name} in {cache_dir}")
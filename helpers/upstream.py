@@ -0,0 +1,235 @@
+import asyncio
+import time
+from typing import AsyncIterator, List, Optional
+
+import aiohttp
+
+from helpers.metrics import counter
+from helpers.openai_client import OPENAI_CHAT_URL, OpenAIClient, UpstreamError
+
+UPSTREAM_REQUESTS = counter("chatbot_upstream_requests_total", "Upstream requests per endpoint, by result")
+
+# statuses that say nothing about the endpoint itself: every endpoint would answer the same
+REQUEST_ERRORS = (400, 404, 413, 422)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stream is stopped at its deadline, `stage` is "first_token" or "total"
+    """
+    def __init__(self, stage: str) -> None:
+        super().__init__(f"upstream deadline exceeded waiting for {stage.replace('_', ' ')}")
+        self.stage = stage
+
+
+class Endpoint:
+    def __init__(
+        self, name: str, url: str, api_key: str, max_concurrent: int = 16, model: Optional[str] = None
+    ) -> None:
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.max_concurrent = max_concurrent
+        # sent instead of the configured engine, for servers naming their models differently
+        self.model = model
+        self.active = 0
+        # moving average of the time to first chunk, None until measured
+        self.latency: Optional[float] = None
+        self.failures = 0
+        # circuit: open until this time, then one probe request may go through
+        self.open_until = 0.0
+        self.probing = False
+
+    def is_open(self, now: float) -> bool:
+        return self.open_until > now
+
+    def is_available(self, now: float) -> bool:
+        if self.active >= self.max_concurrent or self.is_open(now):
+            return False
+        # half open: only the probe until it answers
+        return not (self.open_until and self.probing)
+
+
+class UpstreamPool:
+    """
+    Routes each chat completion to the healthy endpoint with the lowest expected wait:
+    the moving average of its time to first chunk scaled by its requests in flight,
+    endpoints not measured yet first, ties in configured order. Each endpoint has its own
+    concurrency cap, requests wait when every healthy endpoint is full.
+
+    A 429 opens the endpoint's circuit for its Retry-After (or `cooldown`), `failure_threshold`
+    consecutive server or connection errors open it for `cooldown` seconds. After that a single
+    probe request decides whether it closes again. A request that fails before its first chunk
+    is retried on the next endpoint; once chunks were yielded the error is raised.
+
+    Every attempt has `connect_timeout` to connect and `first_token_timeout` for its first
+    chunk (a stalled endpoint counts as a failure and the next one is tried), the whole stream
+    has the caller's deadline. At a deadline the upstream response is closed.
+    """
+    def __init__(
+        self, client: OpenAIClient, endpoints: List[Endpoint], alpha: float = 0.3,
+        failure_threshold: int = 3, cooldown: float = 30.0, connect_timeout: float = 10.0,
+        first_token_timeout: float = 60.0, total_timeout: float = 300.0
+    ) -> None:
+        self.client = client
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.connect_timeout = connect_timeout
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+        self.changed = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls, config: dict, client: OpenAIClient) -> "UpstreamPool":
+        """
+        Endpoints from [[openai.endpoints]] tables (name, url, key, max_concurrent, model),
+        or the single [openai] url/key when there are none
+        """
+        openai = config['openai']
+        endpoints = [
+            Endpoint(
+                name=endpoint.get('name', endpoint['url']), url=endpoint['url'],
+                api_key=endpoint.get('key', openai.get('key', "")),
+                max_concurrent=endpoint.get('max_concurrent', 16), model=endpoint.get('model'),
+            )
+            for endpoint in openai.get('endpoints', [])
+        ]
+        if not endpoints:
+            endpoints.append(Endpoint(
+                "default", openai.get('url', OPENAI_CHAT_URL), openai['key'],
+                max_concurrent=openai.get('max_concurrent', 1000)
+            ))
+        return cls(
+            client, endpoints, alpha=openai.get('latency_alpha', 0.3),
+            failure_threshold=openai.get('failure_threshold', 3), cooldown=openai.get('circuit_cooldown', 30.0),
+            connect_timeout=openai.get('connect_timeout', 10.0),
+            first_token_timeout=openai.get('first_token_timeout', 60.0),
+            total_timeout=openai.get('total_timeout', 300.0),
+        )
+
+    def choose(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in tried and e.is_available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: (e.latency or 0.0) * (e.active + 1))
+
+    async def acquire(self, tried: List[Endpoint]) -> Endpoint:
+        async with self.changed:
+            while True:
+                endpoint = self.choose(tried)
+                if endpoint is not None:
+                    endpoint.active += 1
+                    if endpoint.open_until:
+                        endpoint.probing = True
+                    return endpoint
+                now = time.monotonic()
+                if all(e in tried or e.is_open(now) for e in self.endpoints):
+                    raise UpstreamError(503, "no healthy upstream endpoint left")
+                # the remaining ones are full, or probing
+                await self.changed.wait()
+
+    async def release(self, endpoint: Endpoint) -> None:
+        async with self.changed:
+            endpoint.active -= 1
+            self.changed.notify_all()
+
+    def succeeded(self, endpoint: Endpoint, latency: float) -> None:
+        UPSTREAM_REQUESTS.inc(endpoint=endpoint.name, result="ok")
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.alpha * (latency - endpoint.latency)
+        endpoint.failures = 0
+        endpoint.open_until = 0.0
+        endpoint.probing = False
+
+    def failed(
+        self, endpoint: Endpoint, status: Optional[int] = None, retry_after: Optional[float] = None,
+        reason: str = "error"
+    ) -> None:
+        UPSTREAM_REQUESTS.inc(endpoint=endpoint.name, result=str(status) if status else reason)
+        endpoint.failures += 1
+        if status == 429:
+            endpoint.open_until = time.monotonic() + (retry_after or self.cooldown)
+        elif endpoint.probing or endpoint.failures >= self.failure_threshold:
+            endpoint.open_until = time.monotonic() + self.cooldown
+        endpoint.probing = False
+
+    async def stream_chat(
+        self, json_data: dict, raw: Optional[bytearray] = None, deadline: Optional[float] = None
+    ) -> AsyncIterator[dict]:
+        """
+        OpenAIClient.stream_chat on the best endpoint, failing over until the first chunk.
+        `deadline` is a loop.time() for the whole stream, total_timeout from now by default.
+        Raises DeadlineExceeded when it passes. The timer cancels the consuming task, so the
+        consumer must not await anything else between chunks.
+        """
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = loop.time() + self.total_timeout
+        tried: List[Endpoint] = []
+        raw_start = len(raw) if raw is not None else 0
+        while True:
+            if loop.time() >= deadline:
+                raise DeadlineExceeded("first_token")
+            endpoint = await self.acquire(tried)
+            tried.append(endpoint)
+            payload = dict(json_data, model=endpoint.model) if endpoint.model else json_data
+            started = time.perf_counter()
+            first_deadline = min(loop.time() + self.first_token_timeout, deadline)
+            latency = None
+            stream = self.client.stream_chat(
+                payload, raw, endpoint.url, endpoint.api_key, connect_timeout=self.connect_timeout
+            )
+            try:
+                # one timer per attempt: the first chunk deadline, moved to the stream's deadline
+                # once it arrives. Expiring cancels the pending read, which closes the response.
+                async with asyncio.timeout_at(first_deadline) as scope:
+                    async for resp in stream:
+                        if latency is None:
+                            latency = time.perf_counter() - started
+                            scope.reschedule(deadline)
+                        yield resp
+                self.succeeded(endpoint, latency if latency is not None else time.perf_counter() - started)
+                return
+            except UpstreamError as e:
+                if e.status in REQUEST_ERRORS:
+                    UPSTREAM_REQUESTS.inc(endpoint=endpoint.name, result=str(e.status))
+                    raise
+                self.failed(endpoint, e.status, e.retry_after)
+                if latency is not None:
+                    raise
+                print(f"Upstream {endpoint.name} returned status {e.status}, trying another endpoint.")
+            except aiohttp.ClientError as e:
+                # connect timeouts included
+                self.failed(endpoint)
+                if latency is not None:
+                    raise
+                print(f"Upstream {endpoint.name} failed ({type(e).__name__}), trying another endpoint.")
+            except asyncio.TimeoutError:
+                if latency is not None:
+                    UPSTREAM_REQUESTS.inc(endpoint=endpoint.name, result="deadline")
+                    raise DeadlineExceeded("total") from None
+                if first_deadline < deadline:
+                    self.failed(endpoint, reason="first_token_timeout")
+                if loop.time() >= deadline:
+                    raise DeadlineExceeded("first_token") from None
+                print(f"Upstream {endpoint.name} sent nothing in {self.first_token_timeout}s, trying another endpoint.")
+            finally:
+                await stream.aclose()
+                await self.release(endpoint)
+            if raw is not None:
+                del raw[raw_start:]
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        samples = []
+        for endpoint in self.endpoints:
+            labels = {"endpoint": endpoint.name}
+            samples.append((dict(labels, stat="active"), endpoint.active))
+            samples.append((dict(labels, stat="latency"), endpoint.latency or 0.0))
+            samples.append((dict(labels, stat="open"), int(endpoint.is_open(now))))
+        return samples
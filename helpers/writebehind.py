@@ -0,0 +1,125 @@
+import asyncio
+import sys
+import traceback
+from typing import Awaitable, Callable, List, Optional
+
+from helpers.metrics import counter
+
+ROWS_DROPPED = counter("chatbot_writebehind_dropped_rows_total", "Rows given up by write-behind buffers, per table")
+
+
+class WriteBehind:
+    """
+    Buffers rows of one INSERT statement and writes them in batches.
+    `put` waits when `max_buffer` rows are pending, so a stalled database slows producers
+    down instead of growing memory. A batch is written once `flush_rows` rows are collected
+    or `flush_interval` seconds after its first row, whichever comes first. A batch still
+    failing after `retries` attempts is written row by row, so one bad row only loses itself.
+    """
+    def __init__(
+        self, write: Callable[[List[tuple]], Awaitable[bool]], name: str = "rows", flush_rows: int = 50,
+        flush_interval: float = 1.0, max_buffer: int = 5000, retries: int = 3
+    ) -> None:
+        self.write = write
+        self.name = name
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffer)
+        self.task: Optional[asyncio.Task] = None
+        # set while a flush() waits: retries skip their backoff
+        self.hurry = asyncio.Event()
+        self.flushes = 0
+        self.closing = asyncio.Lock()
+
+    def ensure_running(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def put(self, row: tuple) -> None:
+        self.ensure_running()
+        await self.queue.put(row)
+
+    async def write_batch(self, batch: List[tuple]) -> None:
+        for attempt in range(self.retries):
+            if await self.write(batch):
+                return
+            if attempt + 1 < self.retries and not self.hurry.is_set():
+                try:
+                    await asyncio.wait_for(self.hurry.wait(), attempt + 1)
+                except asyncio.TimeoutError:
+                    pass
+        dropped = 0
+        for row in batch:
+            if not await self.write([row]):
+                dropped += 1
+                print(f"WriteBehind {self.name} dropped row {str(row)[:200]}")
+        if dropped:
+            ROWS_DROPPED.inc(dropped, table=self.name)
+            print(f"WriteBehind {self.name} dropped {dropped} of {len(batch)} row(s) after {self.retries} failed batch write(s).")
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            row = await self.queue.get()
+            batch: List[tuple] = []
+            # flush() markers: resolved once the rows queued before them are written
+            flushed: List[asyncio.Future] = []
+            deadline = loop.time() + self.flush_interval
+            while True:
+                if row is None:
+                    closing = True
+                    break
+                if isinstance(row, asyncio.Future):
+                    flushed.append(row)
+                    break
+                batch.append(row)
+                if len(batch) >= self.flush_rows:
+                    break
+                try:
+                    if self.queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        row = await asyncio.wait_for(self.queue.get(), timeout)
+                    else:
+                        row = self.queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+            try:
+                if batch:
+                    await self.write_batch(batch)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            for future in flushed:
+                self.flushes -= 1
+                if not future.done():
+                    future.set_result(None)
+            if not self.flushes:
+                self.hurry.clear()
+
+    async def flush(self) -> None:
+        """
+        Wait until every row put so far is written (or dropped), the writer keeps running
+        """
+        if self.task is None and self.queue.empty():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.flushes += 1
+        self.hurry.set()
+        self.ensure_running()
+        await self.queue.put(future)
+        await future
+
+    async def close(self) -> None:
+        """
+        Write every pending row and stop, concurrent calls wait for the same stop
+        """
+        async with self.closing:
+            # rows left behind by a writer that already stopped, or put while it was stopping
+            while not self.queue.empty() or (self.task is not None and not self.task.done()):
+                self.ensure_running()
+                await self.queue.put(None)
+                await self.task
+            self.task = None